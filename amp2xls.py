@@ -167,6 +167,7 @@ def amp2xls(xls_in,  # args.xls_in
             csvfile=None,  # args.txtfile
             differential=False,  # args.differential
             prepend="",  # args.prepend
+            shp_cache=False,  # args.shp_cache
             verbose=False):  # args.verbose
 
     # Some default values that can be turned into arguments later on
@@ -212,12 +213,10 @@ def amp2xls(xls_in,  # args.xls_in
     # If selected, open the shapefile containing displacement data
     sf = ""
     if shp_in is not None:
-       # Load shapefile data
-        shp = shp2df(shp_in, out_srs=xls_srs)
-        shp_dat = shp.getDF()
-        # Initialize spatial search tree
+        # Open the shapefile. The data is loaded once the dates are known.
+        shp = shp2df(shp_in, out_srs=xls_srs, cache=shp_cache)
         [shp_x_lbl, shp_y_lbl] = shp.getCooLabels()
-        kdt = KDTree(shp_dat[[shp_x_lbl, shp_y_lbl]].values)
+        shp_fields = sorted(shp.getFields())
         sf = "_SHP"
 
     # If selected, load the temporary scatterer files
@@ -409,6 +408,18 @@ def amp2xls(xls_in,  # args.xls_in
 
             # If shapefile need to be analyzed
             if shp_in is not None:
+                # Only load the date fields required by the selected period
+                # and all the other attributes
+                dates = process_date_range(shp_fields, min_date, max_date, differential, prefix='D')
+                if dates is None:
+                    exit("\nERROR -> No dates found inside {}".format(shp_fields))
+                shp.setColumns([f for f in shp_fields if f not in dates or dates[f]['processing'] != 'skip'])
+
+                # Load shapefile data and initialize spatial search tree
+                if not shp.getDataLoaded():
+                    shp_dat = shp.getDF()
+                    kdt = KDTree(shp_dat[[shp_x_lbl, shp_y_lbl]].values)
+
                 # Clear the xls data outside the shapefile bounding box
                 shp_extent = shp.getExtent()
                 xldata = xldata[xldata[slng] >= shp_extent[0]]
@@ -658,7 +669,10 @@ if __name__ == "__main__":
                         'DYYYYMMDD'.")
     parser.add_argument("-s", "--shp_in",
                         help="Name of the shapefile containing the SqueeSAR \
-                        displacement data.")
+                        displacement data. If a regular expression is used, \
+                        it should be enclosed in double quotes. All the \
+                        shapefiles (tiles) identified by the expression will \
+                        be merged.")
     parser.add_argument("-t", "--ts_in",
                         help="Base name of the raster files containing the \
                         temporary scatterers data. If a regular expression is \
@@ -749,6 +763,12 @@ if __name__ == "__main__":
                         help="A string to prepend to the output file names \
                         (default: %(default)s).")
 
+    parser.add_argument("--shp_cache",
+                        action="store_true",
+                        help="If selected, the shapefile data is cached next \
+                        to the shapefile and loaded from the cache by the \
+                        following runs (until the shapefile changes).")
+
     parser.add_argument("--verbose",
                         action="store_true",
                         help="Increase the verbosity of the output.")
@@ -770,4 +790,5 @@ if __name__ == "__main__":
             args.csvfile,
             args.differential,
             args.prepend,
+            args.shp_cache,
             args.verbose)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    bandstats.py
+Purpose: Single-pass statistics of a raster band computed over chunks
+"""
+
+
+try:
+    import numpy as np
+except ImportError:
+    exit("\nERROR -> Numpy required")
+
+
+# Accumulate the statistics of a band one chunk at a time
+class bandstats(object):
+    """
+    Accumulates minimum, maximum, mean and standard deviation of the valid
+    pixels of a band (not NaN and different from `ndv`) while its chunks are
+    passed to `update`. Partial statistics (e.g. from different workers) are
+    combined with `merge` using Chan's parallel formulas.
+    When `step` is larger than 1, only one pixel every `step` rows and
+    columns of each chunk is used and the statistics are approximate.
+    """
+    def __init__(self, ndv=None, step=1):
+        self.ndv = ndv
+        self.step = max(1, int(step))
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def update(self, data):
+        """
+        Adds the valid pixels of the array `data` to the statistics.
+        """
+        data = np.asarray(data)
+        if self.step > 1:
+            data = data[(slice(None, None, self.step),) * data.ndim]
+        valid = None
+        if data.dtype.kind in 'fc':
+            valid = ~np.isnan(data)
+        if self.ndv is not None and not np.isnan(self.ndv):
+            valid = data != self.ndv if valid is None else valid & (data != self.ndv)
+        data = data.ravel() if valid is None else data[valid]
+        if data.size == 0:
+            return self
+
+        chunk = bandstats()
+        chunk.count = data.size
+        chunk.mean = np.mean(data, dtype=np.float64)
+        chunk.m2 = np.sum((data - chunk.mean) ** 2, dtype=np.float64)
+        chunk.min = np.min(data)
+        chunk.max = np.max(data)
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """
+        Adds the statistics accumulated by `other` to these ones.
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def std(self):
+        """
+        Returns the (population) standard deviation of the valid pixels.
+        """
+        if self.count == 0:
+            return None
+        return np.sqrt(self.m2 / self.count)
+
+    def metadata(self):
+        """
+        Returns the dictionary of STATISTICS_* items to be set as band
+        metadata or an empty dictionary if no valid pixel was found.
+        """
+        if self.count == 0:
+            return {}
+        meta = {'STATISTICS_MAXIMUM': str(self.max),
+                'STATISTICS_MINIMUM': str(self.min),
+                'STATISTICS_MEAN': str(self.mean),
+                'STATISTICS_STDDEV': str(self.std())}
+        if self.step > 1:
+            meta['STATISTICS_APPROXIMATE'] = 'YES'
+        return meta
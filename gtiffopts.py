@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Name:    gtiffopts.py
+Purpose: Creation options of the GeoTIFF files written by the tools
+"""
+
+
+try:
+    from osgeo import gdal
+except ImportError:
+    exit("\nERROR -> Osgeo/gdal package is required")
+
+try:
+    from osgeo import gdal_array
+except ImportError:
+    exit("\nERROR -> Osgeo/gdal_array package is required")
+
+try:
+    import numpy as np
+except ImportError:
+    exit("\nERROR -> Numpy package is required")
+
+
+# Named creation profiles: compression, compression level (None for the
+# default one), tile size and number of compression threads
+PROFILES = {'default': {'compress': 'DEFLATE', 'level': None, 'blocksize': 256, 'threads': 'ALL_CPUS'},
+            'fast-write': {'compress': 'ZSTD', 'level': 1, 'blocksize': 512, 'threads': 'ALL_CPUS'},
+            'small': {'compress': 'DEFLATE', 'level': 9, 'blocksize': 512, 'threads': 'ALL_CPUS'},
+            'fast-random-read': {'compress': 'LZW', 'level': None, 'blocksize': 128, 'threads': 'ALL_CPUS'}}
+
+# Name of the creation option setting the compression level
+LEVEL_OPTION = {'DEFLATE': 'ZLEVEL', 'ZSTD': 'ZSTD_LEVEL'}
+
+
+def gtiff_options(dtype, profile='default', compress=None, level=None, blocksize=None, threads=None):
+    """
+    Returns the list of GeoTIFF creation options of the named `profile` for
+    bands of type `dtype` (GDAL type code or numpy type). The remaining
+    parameters, when defined, override the ones of the profile. The predictor
+    is chosen from the data type (3 for floating point, 2 for integers) and
+    compressions not supported by the GDAL build fall back to DEFLATE.
+    """
+    if profile not in PROFILES:
+        exit("\nERROR -> Unknown GeoTIFF profile '{0}' (valid: {1})".format(profile, ", ".join(sorted(PROFILES))))
+    prof = dict(PROFILES[profile])
+    for key, val in (('compress', compress), ('level', level), ('blocksize', blocksize), ('threads', threads)):
+        if val is not None:
+            prof[key] = val
+
+    compress = prof['compress'].upper()
+    opt_list = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST')
+    if compress != 'NONE' and opt_list and compress not in opt_list:
+        print "\nWARNING -> {0} compression not available, using DEFLATE".format(compress)
+        compress = 'DEFLATE'
+        prof['level'] = None
+
+    opts = ['TILED=YES',
+            'BLOCKXSIZE={0}'.format(prof['blocksize']),
+            'BLOCKYSIZE={0}'.format(prof['blocksize']),
+            'BIGTIFF=IF_SAFER',
+            'COMPRESS={0}'.format(compress)]
+    if compress == 'NONE':
+        return opts
+
+    if prof['level'] is not None and compress in LEVEL_OPTION:
+        opts.append('{0}={1}'.format(LEVEL_OPTION[compress], prof['level']))
+    if isinstance(dtype, (int, long)):
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(dtype)
+    kind = np.dtype(dtype).kind
+    if kind == 'f':
+        opts.append('PREDICTOR=3')
+    elif kind in 'iu':
+        opts.append('PREDICTOR=2')
+    if prof['threads']:
+        opts.append('NUM_THREADS={0}'.format(prof['threads']))
+    return opts
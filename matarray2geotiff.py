@@ -17,12 +17,10 @@ ymax = data['ymax']
 finpro = data['finpro']
 
 import numpy as np
+from bandstats import bandstats
 
 finpro[finpro == 1.0] = -9999.0
-finpro_min = np.min(finpro[finpro != -9999.0])
-finpro_max = np.max(finpro[finpro != -9999.0])
-finpro_ave = np.average(finpro[finpro != -9999.0])
-finpro_stdev = np.std(finpro[finpro != -9999.0])
+finpro_stats = bandstats(-9999.0).update(finpro)
 
 (rows, cols) = np.shape(finpro)
 
@@ -32,14 +30,15 @@ srs = osr.SpatialReference()
 srs.ImportFromEPSG(102746)
 
 from osgeo import gdal
+from gtiffopts import gtiff_options
 
 driver = gdal.GetDriverByName('GTiff')
-file_out = driver.Create('propagated.tif', cols, rows, 1, gdal.GDT_Float32, ['COMPRESS=DEFLATE', 'PREDICTOR=3'])
+file_out = driver.Create('propagated.tif', cols, rows, 1, gdal.GDT_Float32, gtiff_options(gdal.GDT_Float32))
 file_out.SetProjection(srs.ExportToWkt())
 geotrans = (float(xmin), float((xmax - xmin) / cols), 0.0, float(ymin), 0.0, float((ymax - ymin) / rows))
 file_out.SetGeoTransform(geotrans)
 band_out = file_out.GetRasterBand(1)
-band_out.SetMetadata({'STATISTICS_MAXIMUM':str(finpro_max), 'STATISTICS_MINIMUM':str(finpro_min), 'STATISTICS_MEAN':str(finpro_ave), 'STATISTICS_STDDEV':str(finpro_stdev)})
+band_out.SetMetadata(finpro_stats.metadata())
 band_out.SetNoDataValue(-9999.0)
 band_out.WriteArray(finpro)
 band_out = None
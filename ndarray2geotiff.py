@@ -34,8 +34,11 @@ except ImportError:
     print("GDAL module required!")
     sys.exit(1)
 
+from bandstats import bandstats
+from gtiffopts import gtiff_options
+
 if len(sys.argv) < 4:
-    print("Usage: ndarray2tiff.py array_file(.npy) template_file(.tif) dest_file(.tif)")
+    print("Usage: ndarray2tiff.py array_file(.npy) template_file(.tif) dest_file(.tif) [profile]")
     sys.exit(1)
 
 #==============================================================================
@@ -52,14 +55,11 @@ except IOError:
 print("\nGathering array information:")
 (xsize, ysize) = np.shape(array_in)
 print(" Shape (rows: {0}, cols:{1})".format(ysize, xsize))
-stat_min = np.nanmin(array_in)
-print(" Minimum: {0:03.2f}".format(stat_min))
-stat_max = np.nanmax(array_in)
-print(" Maximum: {0:03.2f}".format(stat_max))
-stat_mean = np.nanmean(array_in)
-print(" Mean: {0:03.2f}".format(stat_mean))
-stat_stddev = np.nanstd(array_in)
-print(" Standard Deviation: {0:03.2f}".format(stat_stddev))
+stats = bandstats().update(array_in)
+print(" Minimum: {0:03.2f}".format(stats.min))
+print(" Maximum: {0:03.2f}".format(stats.max))
+print(" Mean: {0:03.2f}".format(stats.mean))
+print(" Standard Deviation: {0:03.2f}".format(stats.std()))
 array_tmp = None
 
 #==============================================================================
@@ -93,7 +93,8 @@ template = None
 print("\nWriting GeoTIFF...")
 data_format = "GTiff"
 driver = gdal.GetDriverByName(data_format)
-file_out = driver.Create(sys.argv[3], ysize, xsize, 1, gdal.GDT_Float32, ['COMPRESS=DEFLATE', 'PREDICTOR=3'])
+profile = sys.argv[4] if len(sys.argv) > 4 else 'default'
+file_out = driver.Create(sys.argv[3], ysize, xsize, 1, gdal.GDT_Float32, gtiff_options(gdal.GDT_Float32, profile))
 
 file_out.SetProjection(projection)
 file_out.SetGeoTransform(geotransform)
@@ -102,10 +103,7 @@ file_out.SetMetadata = metadata
 band_out = file_out.GetRasterBand(1)
 
 band_out.SetNoDataValue(no_data)
-band_out.SetMetadata({'STATISTICS_MAXIMUM': str(stat_max),
-                      'STATISTICS_MINIMUM': str(stat_min),
-                      'STATISTICS_MEAN': str(stat_mean),
-                      'STATISTICS_STDDEV': str(stat_stddev)})
+band_out.SetMetadata(stats.metadata())
 array_in[np.isnan(array_in)] = no_data
 band_out.WriteArray(array_in)
 print("...done!")
@@ -17,6 +17,11 @@ try:
 except ImportError:
     exit("\nERROR -> OSR required to handle projections")
 
+try:
+    import numpy as np
+except ImportError:
+    exit("\nERROR -> Numpy required")
+
 
 # Transform coordinates from one spatial reference to another
 class prjpnt(object):
@@ -52,6 +57,19 @@ class prjpnt(object):
         else:
             return coo_src
 
+    def prj_arr(self, x_src, y_src):
+        """
+        Transform arrays of X and Y coordinates using a single call and
+        returns the transformed X and Y arrays.
+        """
+        x_src = np.asarray(x_src, dtype=float)
+        y_src = np.asarray(y_src, dtype=float)
+        if self.ok and len(x_src):
+            coo = np.array(self.trans.TransformPoints(zip(x_src.tolist(), y_src.tolist())))
+            return coo[:, 0], coo[:, 1]
+        else:
+            return x_src, y_src
+
     def isok(self):
         return self.ok
 
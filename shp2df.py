@@ -6,7 +6,17 @@ Purpose: Load a shapefile and stores it into a dataframe.
 Author:  Andrea Vaccari (av9g@virginia.edu)
 """
 
-from os.path import splitext
+import re
+import json
+from glob import glob
+from hashlib import md5
+from shutil import rmtree
+from struct import unpack
+from datetime import datetime as dt
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from os import makedirs, listdir, rename, remove, getpid, stat
+from os.path import splitext, getsize, basename, join, exists, isdir
 
 try:
     import shapefile as shp
@@ -34,20 +44,74 @@ except ImportError:
     exit("\nERROR -> Pandas required to edit excel XLS files")
 
 
-# Reads a point shapefile and returns a dataframe
-class shp2df(object):
+# Layout of a point record within the .shp file: the record header (record
+# number and content length in 16-bit words, big endian) followed by the shape
+# type and the point coordinates (little endian). Every record is 28 bytes.
+SHP_HEADER_SIZE = 100
+SHP_POINT_DTYPE = np.dtype([('num', '>i4'),
+                            ('len', '>i4'),
+                            ('type', '<i4'),
+                            ('x', '<f8'),
+                            ('y', '<f8')])
+
+# Layout of the .shx index records: offset of the record within the .shp file
+# and content length, both in 16-bit words (big endian)
+SHX_RECORD_DTYPE = np.dtype([('off', '>i4'),
+                             ('len', '>i4')])
+
+# Number of records gathered at once through the .shx index
+SHX_GATHER_BLOCK = 65536
+
+# Number of points used to densify the edges of the query bounding box when
+# converting it to the shapefile spatial reference
+BBOX_EDGE_PNTS = 21
+
+# Name of the fields containing the displacement at a given date
+DISP_FIELD_RE = "D[0-9]{8}"
+
+# Extension of the directory, next to the shapefile, storing the cached columns
+CACHE_EXT = '.shp2df'
+
+# Version of the cached columns, changed to discard the caches written by
+# previous versions
+CACHE_VERSION = 4
+
+
+def date_range(min_date, max_date):
     """
-    Reads a point geometry shapefile and stores it in a pandas dataframe.
+    Returns a column selector accepting the displacement fields (`D########`)
+    whose date falls within `[min_date, max_date]` (datetime objects).
+    """
+    def in_range(name):
+        if not re.match(DISP_FIELD_RE + "$", name):
+            return False
+        return min_date <= dt.strptime(name[1:], "%Y%m%d") <= max_date
+
+    return in_range
+
+
+def _in_box(x, y, box):
+    """
+    Returns the mask of the points inside `box` (`[Min_X, Min_Y, Max_X, Max_Y]`).
     """
+    return (x >= box[0]) & (x <= box[2]) & (y >= box[1]) & (y <= box[3])
 
-    # TODO: allow multiple shape files. This requires the merging of the data
-    # between the multiple files into a single dataframe to be returned
-    def __init__(self, shp_in, out_srs=None):
+
+# Reads a single point shapefile (tile) into a dictionary of columns
+class _shpTile(object):
+    """
+    Reads the coordinates and the attributes of a single point geometry
+    shapefile.
+    """
+
+    def __init__(self, shp_in, out_srs=None, disp_dtype=np.float64, cache=False, bbox=None):
         print "\nOpening and reading shapefile '{0}'.".format(shp_in)
         try:
             self.__shp_rd = shp.Reader(shp_in)
         except shp.ShapefileException:
             exit("\nERROR -> File '{0}' not found".format(shp_in))
+        self.__shp_file = splitext(shp_in)[0] + '.shp'
+        self.__dbf_file = splitext(shp_in)[0] + '.dbf'
 
         # Import projection
         prj_file = splitext(shp_in)[0] + '.prj'
@@ -62,22 +126,466 @@ class shp2df(object):
                 if self.__shp_srs.ImportFromESRI([prj_txt]) != 0:
                     exit("\nERROR -> Error importing the projection information from '{0}'.".format(shp_in))
 
-        # Store requested spatial reference
-        self.__out_srs = out_srs
-
         # If destination coordinates are specified
-        if self.__out_srs:
+        if out_srs:
             # Define the coordinates transformation
-            self.__trans = prjpnt(self.__shp_srs, self.__out_srs)
+            self.__trans = prjpnt(self.__shp_srs, out_srs)
         else:
             self.__trans = None
 
+        # Store the type of the displacement columns
+        self.__disp_dtype = disp_dtype
+
+        # Query bounding box, both in output and in shapefile coordinates. The
+        # latter is the envelope of the densified box edges and it is used to
+        # discard the points before their conversion.
+        self.__bbox = bbox
+        self.__src_bbox = bbox
+        if bbox is not None and out_srs:
+            bx = np.linspace(bbox[0], bbox[2], BBOX_EDGE_PNTS)
+            by = np.linspace(bbox[1], bbox[3], BBOX_EDGE_PNTS)
+            src_x, src_y = prjpnt(out_srs, self.__shp_srs).prj_arr(
+                np.concatenate((bx, bx, np.repeat(bbox[0], BBOX_EDGE_PNTS), np.repeat(bbox[2], BBOX_EDGE_PNTS))),
+                np.concatenate((np.repeat(bbox[1], BBOX_EDGE_PNTS), np.repeat(bbox[3], BBOX_EDGE_PNTS), by, by)))
+            self.__src_bbox = [np.min(src_x), np.min(src_y), np.max(src_x), np.max(src_y)]
+
+        # Columns cache
+        self.__cache = cache
+        self.__cache_dir = splitext(shp_in)[0] + CACHE_EXT
+        self.__out_wkt = out_srs.ExportToWkt() if out_srs else ''
+
+        # Types of the numeric fields
+        self.__num_types = {}
+
+    def getName(self):
+        """
+        Returns the name of the .shp file.
+        """
+        return basename(self.__shp_file)
+
+    def getFields(self):
+        """
+        Returns the descriptors `[name, type, size, decimals]` of the
+        attribute fields.
+        """
+        return self.__shp_rd.fields[1:]
+
+    def getSrs(self):
+        """
+        Returns the shapefile spatial reference as an OSR object.
+        """
+        return self.__shp_srs
+
+    def getBbox(self):
+        """
+        Returns the bounding box stored within the shapefile in the output
+        coordinates.
+        """
+        bbox_in = list(self.__shp_rd.bbox)
+        if self.__trans:
+            bbox = self.__trans.prj_coo(bbox_in[:2])
+            bbox.extend(self.__trans.prj_coo(bbox_in[2:]))
+            return bbox
+        return bbox_in
+
+    def __loadPoints(self):
+        """
+        Loads the coordinates of the point records and returns the indices of
+        the point records within the shapefile together with their X and Y
+        coordinates. If the shapefile only contains points, every record has
+        the same fixed layout and the .shp file is memory mapped into a numpy
+        structured array, so that X and Y are views on the file. If it also
+        contains null records, the point records are located through the .shx
+        index and gathered from the memory mapped .shp file. Otherwise the
+        geometries are read one at a time through pyshp.
+        """
+        shp_len = getsize(self.__shp_file)
+        n_rec = (shp_len - SHP_HEADER_SIZE) // SHP_POINT_DTYPE.itemsize
+        if (self.__shp_rd.shapeType == 1 and n_rec > 0 and
+                shp_len == SHP_HEADER_SIZE + n_rec * SHP_POINT_DTYPE.itemsize):
+            pnts = np.memmap(self.__shp_file, dtype=SHP_POINT_DTYPE, mode='r',
+                             offset=SHP_HEADER_SIZE, shape=(n_rec,))
+            # Content length of a point record is 10 16-bit words
+            if np.all(pnts['len'] == 10):
+                is_pnt = pnts['type'] == 1
+                if np.all(is_pnt):
+                    return np.arange(n_rec), pnts['x'], pnts['y']
+                return np.flatnonzero(is_pnt), pnts['x'][is_pnt], pnts['y'][is_pnt]
+
+        shx_file = splitext(self.__shp_file)[0] + '.shx'
+        if self.__shp_rd.shapeType == 1 and exists(shx_file):
+            n_rec = (getsize(shx_file) - SHP_HEADER_SIZE) // SHX_RECORD_DTYPE.itemsize
+            if n_rec == 0:
+                return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+            shx = np.memmap(shx_file, dtype=SHX_RECORD_DTYPE, mode='r',
+                            offset=SHP_HEADER_SIZE, shape=(n_rec,))
+            # Gather the content (shape type and coordinates) of the point
+            # records, skipping their record header
+            idx = np.flatnonzero(shx['len'] == 10)
+            start = 2 * shx['off'][idx].astype(np.int64) + 8
+            size = SHP_POINT_DTYPE.itemsize - 8
+            raw = np.memmap(self.__shp_file, dtype=np.uint8, mode='r')
+            pnts = np.empty(len(idx), dtype=SHP_POINT_DTYPE.descr[2:])
+            for b in xrange(0, len(idx), SHX_GATHER_BLOCK):
+                blk = start[b:b + SHX_GATHER_BLOCK, np.newaxis] + np.arange(size)
+                pnts[b:b + SHX_GATHER_BLOCK] = raw[blk].view(pnts.dtype).ravel()
+            is_pnt = pnts['type'] == 1
+            return idx[is_pnt], pnts['x'][is_pnt], pnts['y'][is_pnt]
+
+        # Mixed records: drop non point shapes
+        idx = []
+        coo = []
+        for i, s in enumerate(self.__shp_rd.iterShapes()):
+            if s.shapeType == 1:
+                idx.append(i)
+                coo.append(s.points[0])
+        coo = np.array(coo, dtype=float).reshape(-1, 2)
+
+        return np.array(idx, dtype=int), coo[:, 0], coo[:, 1]
+
+    def __outsideBox(self):
+        """
+        Returns `True` if the bounding box in the shapefile header doesn't
+        overlap the query box, i.e. the file can't contain any point inside it.
+        """
+        if self.__src_bbox is None:
+            return False
+        bb = self.__shp_rd.bbox
+        return (bb[0] > self.__src_bbox[2] or bb[2] < self.__src_bbox[0] or
+                bb[1] > self.__src_bbox[3] or bb[3] < self.__src_bbox[1])
+
+    def __mapRecords(self):
+        """
+        Memory maps the records of the .dbf file into a numpy structured array
+        with one fixed width string field for each attribute. The first field
+        contains the deletion flag of the record.
+        """
+        with open(self.__dbf_file, 'rb') as dbf:
+            n_rec, hdr_len, rec_len = unpack("<xxxxLHH20x", dbf.read(32))
+
+        names = []
+        formats = []
+        offsets = []
+        pos = 0
+        for f in self.__shp_rd.fields:
+            names.append(f[0])
+            formats.append('S{0}'.format(f[2]))
+            offsets.append(pos)
+            pos += f[2]
+        rec_dtype = np.dtype({'names': names,
+                              'formats': formats,
+                              'offsets': offsets,
+                              'itemsize': rec_len})
+        if n_rec == 0:
+            return np.zeros(0, dtype=rec_dtype)
+
+        return np.memmap(self.__dbf_file, dtype=rec_dtype, mode='r',
+                         offset=hdr_len, shape=(n_rec,))
+
+    def __numericType(self, field, recs):
+        """
+        Returns the type of the numeric .dbf field with descriptor `field`.
+        Integer fields are decoded as integers only if no value is missing
+        from the whole column of the records `recs`, so that the type doesn't
+        depend on the records decoded at once. The type is computed once.
+        """
+        name, typ, size, deci = field[:4]
+        if name not in self.__num_types:
+            if re.match(DISP_FIELD_RE, name):
+                dtype = self.__disp_dtype
+            elif deci:
+                dtype = np.float64
+            else:
+                try:
+                    recs[name].astype(np.int64)
+                    dtype = np.int64
+                except ValueError:
+                    dtype = np.float64
+            self.__num_types[name] = dtype
+        return self.__num_types[name]
+
+    def __decodeField(self, field, recs, idx):
+        """
+        Decodes the fixed width strings of a .dbf field for the records `idx`
+        of `recs` into a typed array using the field descriptor `[name, type,
+        size, decimals]`.
+        """
+        name, typ, size, deci = field[:4]
+        raw = recs[name][idx]
+        if typ in ('N', 'F'):
+            dtype = self.__numericType(field, recs)
+            try:
+                return raw.astype(dtype)
+            except ValueError:
+                # Blank (or QGIS '*' filled) values are missing
+                raw = np.char.strip(np.char.replace(raw, '*', ''))
+                valid = raw != ''
+                out = np.full(len(raw), np.nan, dtype=dtype)
+                out[valid] = raw[valid].astype(dtype)
+                return out
+        elif typ == 'D':
+            return pd.to_datetime(raw, format="%Y%m%d", errors='coerce').values
+        elif typ == 'L':
+            return np.in1d(raw, ['Y', 'y', 'T', 't', '1'])
+        else:
+            return np.char.strip(raw)
+
+    def loadData(self, coo_lbl, fields):
+        """
+        Loads the point coordinates, converted to the output spatial
+        reference, and the attribute `fields` (names) of the point records.
+        Returns a dictionary of arrays keyed by the labels in `coo_lbl` and by
+        the field names.
+        """
+        for data in self.iterData(coo_lbl, fields):
+            return data
+
+    def iterData(self, coo_lbl, fields, n_rows=None):
+        """
+        Generator returning the same dictionary as `loadData` for consecutive
+        blocks of `n_rows` point records (all the records if `None`). Points
+        whose attributes are marked as deleted, or outside the query bounding
+        box, are dropped, so blocks can be shorter than `n_rows`. Attributes
+        are only decoded for the points kept.
+        """
+        recs = self.__mapRecords()
+        fields = [f for f in self.getFields() if f[0] in fields]
+
+        # Use the cached columns if available
+        cached = self.__loadCache(recs, fields) if self.__cache else None
+        if cached is None and self.__outsideBox():
+            # Skip the file since it can't contain points inside the query box
+            idx, pnt_x, pnt_y = np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+        elif cached is None:
+            # Load the point coordinates from the file
+            idx, pnt_x, pnt_y = self.__loadPoints()
+        else:
+            idx, pnt_x, pnt_y = cached['_idx'], cached['_x'], cached['_y']
+
+        if n_rows is None:
+            n_rows = max(len(idx), 1)
+
+        for start in xrange(0, max(len(idx), 1), n_rows):
+            data = {}
+            c_idx = idx[start:start + n_rows]
+            shp_x = pnt_x[start:start + n_rows]
+            shp_y = pnt_y[start:start + n_rows]
+
+            if cached is None:
+                # Discard the points outside the query box before converting
+                # them (and reading their attributes)
+                if self.__src_bbox is not None:
+                    inside = _in_box(shp_x, shp_y, self.__src_bbox)
+                    c_idx, shp_x, shp_y = c_idx[inside], shp_x[inside], shp_y[inside]
+
+                # Drop the points whose attributes are marked as deleted
+                c_idx, shp_x, shp_y = self.__keepRecords(recs, c_idx, shp_x, shp_y)
+
+                # If destination coordinates are specified
+                if self.__trans:
+                    # Convert the coordinates to the destination spatial reference
+                    shp_x, shp_y = self.__trans.prj_arr(shp_x, shp_y)
+
+            # Keep the points inside the query box
+            inside = None
+            if self.__bbox is not None:
+                inside = _in_box(shp_x, shp_y, self.__bbox)
+                c_idx, shp_x, shp_y = c_idx[inside], shp_x[inside], shp_y[inside]
+            data[coo_lbl[0]] = shp_x
+            data[coo_lbl[1]] = shp_y
+
+            # Decode the non-geometry data of the point records one column at
+            # a time straight from the fixed width records
+            for f in fields:
+                if cached is None:
+                    data[f[0]] = self.__decodeField(f, recs, c_idx)
+                elif inside is None:
+                    data[f[0]] = cached[f[0]][start:start + n_rows]
+                else:
+                    data[f[0]] = cached[f[0]][start:start + n_rows][inside]
+
+            yield data
+
+    def __keepRecords(self, recs, idx, shp_x, shp_y):
+        """
+        Drops the points whose attributes are marked as deleted.
+        """
+        keep = recs[self.__shp_rd.fields[0][0]][idx] != '*'
+        if not np.all(keep):
+            return idx[keep], shp_x[keep], shp_y[keep]
+        return idx, shp_x, shp_y
+
+    def __cacheKey(self):
+        """
+        Returns the key identifying the cached columns: size and modification
+        time of the .shp, .dbf and .prj files, output spatial reference,
+        type of the displacement columns and version of the cache layout.
+        """
+        key = {'version': CACHE_VERSION}
+        for ext in ('.shp', '.dbf', '.prj'):
+            st = stat(splitext(self.__shp_file)[0] + ext)
+            key[ext] = [st.st_size, st.st_mtime]
+        key['srs'] = self.__out_wkt
+        key['disp_dtype'] = np.dtype(self.__disp_dtype).str
+        return key
+
+    def __cachePath(self, key):
+        """
+        Returns the directory containing the cached columns for `key`.
+        """
+        return join(self.__cache_dir, md5(json.dumps(key, sort_keys=True)).hexdigest())
+
+    def __saveCache(self, path, name, arr):
+        """
+        Stores the array `arr` within the cache directory `path`. The file is
+        renamed once complete so that concurrent readers never see it partial.
+        """
+        fname = join(path, name + '.npy')
+        tmp = "{0}.{1}.tmp".format(fname, getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(arr))
+        try:
+            rename(tmp, fname)
+        except OSError:
+            # Already stored by another process
+            remove(tmp)
+
+    def __loadCache(self, recs, fields):
+        """
+        Returns a dictionary containing the cached point indices (`_idx`), the
+        converted coordinates (`_x`, `_y`) and the columns of `fields` as
+        memory mapped arrays. The columns missing from the cache are loaded
+        from the shapefile and stored, always for all the points (the query
+        box is applied by the caller). Returns `None` if the cache is not
+        available.
+        """
+        key = self.__cacheKey()
+        path = self.__cachePath(key)
+        cols = {}
+        try:
+            if not exists(path):
+                makedirs(path)
+                with open(join(path, 'key.json'), 'w') as f:
+                    json.dump(key, f, sort_keys=True)
+
+            # Coordinates of the non deleted points
+            if not all(exists(join(path, c + '.npy')) for c in ('_idx', '_x', '_y')):
+                print "- Caching coordinates of '{0}'".format(self.getName())
+                idx, shp_x, shp_y = self.__loadPoints()
+                idx, shp_x, shp_y = self.__keepRecords(recs, idx, shp_x, shp_y)
+                if self.__trans:
+                    shp_x, shp_y = self.__trans.prj_arr(shp_x, shp_y)
+                self.__saveCache(path, '_idx', idx)
+                self.__saveCache(path, '_x', shp_x)
+                self.__saveCache(path, '_y', shp_y)
+            for c in ('_idx', '_x', '_y'):
+                cols[c] = np.load(join(path, c + '.npy'), mmap_mode='r')
+
+            # Attribute columns
+            for f in fields:
+                fname = join(path, f[0] + '.npy')
+                if not exists(fname):
+                    self.__saveCache(path, f[0], self.__decodeField(f, recs, cols['_idx']))
+                cols[f[0]] = np.load(fname, mmap_mode='r')
+        except (IOError, OSError, ValueError) as e:
+            print "\nWARNING -> Cache '{0}' not available ({1}). Reading the shapefile.".format(path, e)
+            self.__cache = False
+            return None
+
+        return cols
+
+    def purgeCache(self, stale=True):
+        """
+        Removes the cached columns of the shapefile. If `stale` is `True`,
+        only the caches not matching the current .shp, .dbf and .prj files,
+        or written by a previous version of the cache, are removed.
+        """
+        if not isdir(self.__cache_dir):
+            return
+
+        files_key = self.__cacheKey()
+        for d in listdir(self.__cache_dir):
+            path = join(self.__cache_dir, d)
+            if stale:
+                try:
+                    with open(join(path, 'key.json')) as f:
+                        key = json.load(f)
+                except (IOError, ValueError):
+                    key = {}
+                if (key.get('version') == CACHE_VERSION and
+                        all(key.get(ext) == files_key[ext] for ext in ('.shp', '.dbf', '.prj'))):
+                    continue
+            print "- Removing cache '{0}'".format(path)
+            rmtree(path, ignore_errors=True)
+
+        if not listdir(self.__cache_dir):
+            rmtree(self.__cache_dir, ignore_errors=True)
+
+
+# Reads point shapefiles and returns a dataframe
+class shp2df(object):
+    """
+    Reads a point geometry shapefile and stores it in a pandas dataframe.
+    The attributes are decoded column by column from the .dbf file into typed
+    numpy arrays. `disp_dtype` sets the numpy type used for the displacement
+    (`D########`) columns (default: float64, float32 halves their memory).
+    `columns` restricts the attributes decoded from the .dbf file. It can be a
+    field name or a regular expression (e.g. `D[0-9]{8}`), a predicate called
+    with each field name (see `date_range`), or a list of any of these. The
+    point coordinates are always loaded.
+    `shp_in` can also be a glob pattern or a list of shapefiles (e.g. the
+    tiles of a delivery). The tiles are read in parallel by `workers` threads,
+    each is converted to `out_srs` and they are merged into a single dataframe
+    including the union of their fields and a column with the name of the
+    source tile.
+    If `cache` is `True`, the loaded columns are stored in a binary columnar
+    cache next to each shapefile (`<name>.shp2df`) and later loaded memory
+    mapped from it. The cache is keyed by size and modification time of the
+    .shp, .dbf and .prj files and by the output spatial reference. Use
+    `purgeCache` to remove the stale ones.
+    `bbox` (`[Min_X, Min_Y, Max_X, Max_Y]` in the output coordinates) limits
+    the loaded points to the ones inside the box. Only their attributes are
+    decoded from the .dbf file.
+    """
+
+    def __init__(self, shp_in, out_srs=None, disp_dtype=np.float64, columns=None, workers=None, cache=False, bbox=None):
+        # Find the shapefiles to load
+        if isinstance(shp_in, basestring):
+            shp_in = [shp_in]
+        shp_files = []
+        for s in shp_in:
+            tiles = sorted(set(splitext(f)[0] for f in glob(s) if splitext(f)[1].lower() == '.shp'))
+            shp_files.extend(tiles if tiles else [s])
+
+        # Open the tiles
+        self.__tiles = [_shpTile(s, out_srs, disp_dtype, cache, bbox) for s in shp_files]
+
+        # Tiles can only be merged if they share the same coordinates
+        if out_srs is None:
+            for t in self.__tiles[1:]:
+                if not t.getSrs().IsSame(self.__tiles[0].getSrs()):
+                    exit("\nERROR -> Shapefile '{0}' uses a different spatial reference. Define the output spatial reference.".format(t.getName()))
+
+        # Store requested spatial reference
+        self.__out_srs = out_srs
+
+        # Store the selection of the attributes to load
+        self.__columns = columns
+
+        # Number of threads reading the tiles
+        if workers is None:
+            workers = cpu_count()
+        self.__workers = max(1, min(workers, len(self.__tiles)))
+
         # Initialize data loaded indicator
         self.__dataLoaded = False
 
         # Define coordinate labels
         self.__coo_lbl = ['SHP_X', 'SHP_Y']
 
+        # Define source tile label
+        self.__tile_lbl = 'SHP_TILE'
+
         # An empty dictionary to store the data for internal representation
         self.__data = {}
 
@@ -87,6 +595,40 @@ class shp2df(object):
         """
         return self.__coo_lbl
 
+    def getTileLabel(self):
+        """
+        Returns the label used for the name of the source tile. The column is
+        only included when more than one shapefile is loaded.
+        """
+        return self.__tile_lbl
+
+    def getFields(self):
+        """
+        Returns the names of all the attribute fields within the shapefiles.
+        """
+        fields = []
+        for t in self.__tiles:
+            fields.extend(f[0] for f in t.getFields() if f[0] not in fields)
+        return fields
+
+    def setColumns(self, columns):
+        """
+        Changes the selection of the attributes to load (see the class
+        documentation). Loaded data is discarded if the selection changes.
+        """
+        if columns != self.__columns:
+            self.__columns = columns
+            self.__dataLoaded = False
+            self.__data = {}
+
+    def purgeCache(self, stale=True):
+        """
+        Removes the cached columns of the shapefiles. If `stale` is `True`,
+        only the caches not matching the current files are removed.
+        """
+        for t in self.__tiles:
+            t.purgeCache(stale)
+
     def getDataLoaded(self):
         """
         Checks if the data has been loaded
@@ -95,7 +637,8 @@ class shp2df(object):
 
     def getDF(self):
         """
-        Returns the dataframe containing the shapefile data.
+        Returns the dataframe containing the shapefile data (empty, with all
+        the columns, if no point was loaded).
         """
         # Check if data is loaded
         if self.__dataLoaded is False:
@@ -117,34 +660,35 @@ class shp2df(object):
         """
         Returns the original shapefile spatial reference as an OSR object.
         """
-        return self.__shp_srs
+        return self.__tiles[0].getSrs()
 
     def getBbox(self):
         """
         Returns the bounding box as stored within the shapefile. This is stored
         as `[TopLeft_X, TopLeft_Y, Bottom_Right_X, Bottom Right_Y]`.
         """
-        # Load bounding box
-        bbox_in = self.__shp_rd.bbox
-
-        # Check if we need to convert to different spatial reference
-        if self.__trans:
-            self.__bbox = self.__trans.prj_coo(bbox_in[:2])
-            self.__bbox.extend(self.__trans.prj_coo(bbox_in[2:]))
-        else:
-            self.__bbox = bbox_in
+        # Merge the bounding boxes of the tiles
+        bboxes = np.array([t.getBbox() for t in self.__tiles])
+        self.__bbox = list(bboxes[0])
+        if len(bboxes) > 1:
+            self.__bbox = [np.min(bboxes[:, 0]), np.min(bboxes[:, 1]),
+                           np.max(bboxes[:, 2]), np.max(bboxes[:, 3])]
 
         return self.__bbox
 
     def getExtent(self):
         """
         Returns the extent (envelope) of the image in the output coordinates.
-        This is calculated as `[Min_X, Min_Y, Max_X, Max_Y]`'
+        This is calculated as `[Min_X, Min_Y, Max_X, Max_Y]`'. Returns `None`
+        if no point was loaded (e.g. none is inside the query box).
         """
         # Check if data is loaded
         if self.__dataLoaded is False:
             self.__loadData()
 
+        if len(self.__data[self.__coo_lbl[0]]) == 0:
+            return None
+
         # Extract coodrinates extremes for extent calculation
         xmin = np.min(self.__data[self.__coo_lbl[0]])
         xmax = np.max(self.__data[self.__coo_lbl[0]])
@@ -153,35 +697,89 @@ class shp2df(object):
 
         return [xmin, ymin, xmax, ymax]
 
-    def __loadData(self):
+    def iter_chunks(self, n_rows, columns=None):
+        """
+        Generator returning the shapefile data as dataframes of at most
+        `n_rows` rows, with the coordinates converted to the output spatial
+        reference, so that large shapefiles can be processed in fixed memory.
+        `columns` overrides the selection of the attributes to load. The
+        tiles are read one after the other and the index of the dataframes
+        continues from one chunk to the next: concatenated, the chunks match
+        the dataframe returned by `getDF()`.
         """
-        Loads the data from the shapefile.
+        fields = self.__selectFields(self.__columns if columns is None else columns)
+
+        row = 0
+        for t in self.__tiles:
+            for d in t.iterData(self.__coo_lbl, fields, n_rows):
+                n_pnt = len(d[self.__coo_lbl[0]])
+                if n_pnt == 0:
+                    continue
+                if len(self.__tiles) > 1:
+                    d[self.__tile_lbl] = np.repeat(t.getName(), n_pnt)
+                yield pd.DataFrame(d, index=np.arange(row, row + n_pnt))
+                row += n_pnt
+
+    def __selectFields(self, columns):
         """
-        # Load the data from the file and drop non point shapes
-        records = [(r.shape.points[0], r.record) for r in self.__shp_rd.iterShapeRecords() if r.shape.shapeType==1]
-        shp_coo = [r[0] for r in records]
+        Returns the names of the attribute fields matching the `columns`
+        selection, in the order they appear within the shapefiles.
+        """
+        fields = self.getFields()
+        if columns is None:
+            return fields
 
-        # If destination coordinates are specified
-        if self.__trans:
-            # Convert the coordinates to the destination spatial reference
-            xls_coo_x = []
-            xls_coo_y = []
-            for c in shp_coo:
-                coo_out = self.__trans.prj_coo(c)
-                xls_coo_x.append(coo_out[0])
-                xls_coo_y.append(coo_out[1])
-            self.__data[self.__coo_lbl[0]] = xls_coo_x
-            self.__data[self.__coo_lbl[1]] = xls_coo_y
+        if isinstance(columns, (list, tuple, set)):
+            selectors = columns
+        else:
+            selectors = [columns]
+
+        def selected(name):
+            for c in selectors:
+                if callable(c):
+                    if c(name):
+                        return True
+                elif c == name or re.match("(?:{0})$".format(c), name):
+                    return True
+            return False
+
+        return [f for f in fields if selected(f)]
+
+    def __loadData(self):
+        """
+        Loads the data from the shapefiles.
+        """
+        fields = self.__selectFields(self.__columns)
+
+        def load(tile):
+            return tile.loadData(self.__coo_lbl, fields)
+
+        # Load the tiles in parallel
+        if len(self.__tiles) > 1:
+            pool = ThreadPool(self.__workers)
+            try:
+                tiles_data = pool.map(load, self.__tiles)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            self.__data[self.__coo_lbl[0]] = [c[0] for c in shp_coo]
-            self.__data[self.__coo_lbl[1]] = [c[1] for c in shp_coo]
+            tiles_data = [load(self.__tiles[0])]
 
-        # Extract the non-geometry data
-        rec = [r[1] for r in records]
-        itors = map(iter, [r for r in rec])
-        for f in self.__shp_rd.fields[1:]:
-            self.__data[f[0]] = map(next, itors)
+        if len(tiles_data) == 1:
+            self.__data = tiles_data[0]
+        else:
+            # Merge the tiles, filling the fields missing from a tile (columns
+            # sorted by name, as for a single tile)
+            frames = []
+            for t, d in zip(self.__tiles, tiles_data):
+                d[self.__tile_lbl] = np.repeat(t.getName(), len(d[self.__coo_lbl[0]]))
+                frames.append(pd.DataFrame(d))
+            merged = pd.concat(frames, ignore_index=True, sort=True)
+            self.__data = dict((c, merged[c].values) for c in merged.columns)
+
+        # An empty query returns an empty dataframe and no extent
+        if len(self.__data[self.__coo_lbl[0]]) == 0:
+            print "\nWARNING -> No point loaded (none inside the query box)"
 
         # Store the fact that data was loaded
         self.__dataLoaded = True
-
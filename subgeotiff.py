@@ -20,10 +20,13 @@ Fist commit
 
 from shutil import rmtree
 from os import makedirs
-from os.path import join, exists
+from os.path import join, exists, abspath, basename
 from sys import exit
 from glob import glob
+from multiprocessing import Pool
 import argparse
+import re
+import xml.etree.ElementTree as ET
 
 
 try:
@@ -31,6 +34,11 @@ try:
 except ImportError:
     exit("\nERROR -> Osgeo/gdal package is required")
 
+try:
+    from osgeo import gdal_array
+except ImportError:
+    exit("\nERROR -> Osgeo/gdal_array package is required")
+
 try:
     from osgeo import osr
 except ImportError:
@@ -46,8 +54,450 @@ try:
 except ImportError:
     exit("\nERROR -> Numpy package is required")
 
+from bandstats import bandstats
+from gtiffopts import PROFILES, gtiff_options
+
+
+def read_aois(aoi_file, rng_srs):
+    """
+    Reads the named bounding boxes listed in `aoi_file`, one for each line as
+    'name east north west south [srs]' (separated by spaces or commas), where
+    the optional `srs` is 'EPSG:<code>', the URL of a spatial reference or
+    'pixels'. The boxes without `srs` use `rng_srs` (pixels when `None`).
+    Empty lines and lines starting with '#' are skipped.
+    Returns the list of (name, bbox, srs) tuples.
+    """
+    try:
+        with open(aoi_file) as fil:
+            lines = fil.readlines()
+    except IOError as e:
+        exit("\nERROR -> Reading AOI file {0} ({1})".format(aoi_file, e))
+
+    aois = []
+    srs_cache = {}
+    for n, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        items = re.split(r'[,\s]+', line)
+        if len(items) not in (5, 6):
+            exit("\nERROR -> Wrong AOI definition at line {0} of {1}: '{2}'".format(n + 1, aoi_file, line))
+        name = items[0]
+        if name in [a[0] for a in aois]:
+            exit("\nERROR -> Duplicated AOI name '{0}' in {1}".format(name, aoi_file))
+        try:
+            bbox = [float(v) for v in items[1:5]]
+        except ValueError:
+            exit("\nERROR -> Wrong AOI coordinates at line {0} of {1}: '{2}'".format(n + 1, aoi_file, line))
+
+        srs = rng_srs
+        if len(items) == 6:
+            key = items[5]
+            if key not in srs_cache:
+                if key.lower() == 'pixels':
+                    srs_cache[key] = None
+                else:
+                    srs_cache[key] = osr.SpatialReference()
+                    if key.upper().startswith('EPSG:'):
+                        err = srs_cache[key].ImportFromEPSG(int(key[5:]))
+                    else:
+                        err = srs_cache[key].ImportFromUrl(key)
+                    if err != 0:
+                        exit("\nERROR -> Error setting the spatial reference of AOI '{0}' to {1}".format(name, key))
+            srs = srs_cache[key]
+        aois.append((name, bbox, srs))
+
+    if not aois:
+        exit("\nERROR -> No AOI defined in {0}".format(aoi_file))
+    print "\n{0} AOIs read from '{1}'".format(len(aois), aoi_file)
+    return aois
+
+
+def read_cutline(cut_file):
+    """
+    Reads the polygons of the first layer of `cut_file` (any OGR format) and
+    returns them as a single multi-polygon with the layer spatial reference.
+    """
+    cut_ds = ogr.Open(cut_file)
+    if cut_ds is None:
+        exit("\nERROR -> Error opening cutline file {0}".format(cut_file))
+    layer = cut_ds.GetLayer(0)
+    cut_srs = layer.GetSpatialRef()
+    if cut_srs is not None:
+        cut_srs = cut_srs.Clone()
+
+    cut_geom = ogr.Geometry(ogr.wkbMultiPolygon)
+    for feat in layer:
+        geom = feat.GetGeometryRef()
+        if geom is None:
+            continue
+        if geom.GetGeometryType() in (ogr.wkbPolygon, ogr.wkbPolygon25D):
+            cut_geom.AddGeometry(geom)
+        elif geom.GetGeometryType() in (ogr.wkbMultiPolygon, ogr.wkbMultiPolygon25D):
+            for i in xrange(geom.GetGeometryCount()):
+                cut_geom.AddGeometry(geom.GetGeometryRef(i))
+    layer = None
+    cut_ds = None
+
+    if cut_geom.GetGeometryCount() == 0:
+        exit("\nERROR -> No polygon found in cutline file {0}".format(cut_file))
+    print "\n{0} cutline polygons read from '{1}'".format(cut_geom.GetGeometryCount(), cut_file)
+    return cut_geom, cut_srs
+
+
+def cutline_mask(cut_geom, ingeo, window):
+    """
+    Rasterizes `cut_geom` (in the spatial reference of the image) over the
+    pixel `window` of an image with geotransform `ingeo`. Returns the boolean
+    mask of the pixels inside the polygons.
+    """
+    sc, sr, coutsize, routsize = window
+    outgeo = list(ingeo)
+    outgeo[0] += sc * outgeo[1]
+    outgeo[3] += sr * outgeo[5]
+    mask_ds = gdal.GetDriverByName('MEM').Create('', coutsize, routsize, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform(outgeo)
+
+    cut_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = cut_ds.CreateLayer('cutline')
+    feat = ogr.Feature(layer.GetLayerDefn())
+    feat.SetGeometry(cut_geom)
+    layer.CreateFeature(feat)
+    feat = None
+    gdal.RasterizeLayer(mask_ds, [1], layer, burn_values=[1])
+    mask = mask_ds.GetRasterBand(1).ReadAsArray().astype(bool)
+    layer = None
+    cut_ds = None
+    mask_ds = None
+    return mask
+
+
+def build_overviews(fname, overviews, min_size=256):
+    """
+    Builds the overviews of the GeoTIFF `fname` as defined by `overviews`:
+    ('internal' or 'external', resampling method). The levels (2, 4, 8, ...)
+    stop when the smallest overview is within `min_size` pixels.
+    Returns `None` on success or the error message.
+    """
+    where, resampling = overviews
+    if where == "external":
+        gdal.SetConfigOption('COMPRESS_OVERVIEW', 'DEFLATE')
+        fin = gdal.Open(fname, gdal.GA_ReadOnly)
+    else:
+        fin = gdal.Open(fname, gdal.GA_Update)
+    if fin is None:
+        return "\nERROR -> error opening '{0}' to build the overviews".format(fname)
+
+    levels = []
+    level = 2
+    while max(fin.RasterXSize, fin.RasterYSize) > min_size * level // 2:
+        levels.append(level)
+        level *= 2
+    if levels:
+        print "- Building {0} overviews {1} ({2})".format(where, levels, resampling)
+        if fin.BuildOverviews(resampling.upper(), levels) != 0:
+            fin = None
+            return "\nERROR -> error building the overviews of '{0}'".format(fname)
+    fin = None
+
+
+def overlap_groups(jobs):
+    """
+    Splits the `jobs` of the same file in groups of overlapping windows, so
+    that each group can be read once through the window enclosing them.
+    """
+    groups = []
+    for job in jobs:
+        sc, sr, coutsize, routsize = job['window']
+        box = [sc, sr, sc + coutsize, sr + routsize]
+        group = [job]
+        # Absorb the groups touched by the window, growing it as needed
+        for g in list(groups):
+            if box[0] < g[0][2] and g[0][0] < box[2] and box[1] < g[0][3] and g[0][1] < box[3]:
+                box = [min(box[0], g[0][0]), min(box[1], g[0][1]), max(box[2], g[0][2]), max(box[3], g[0][3])]
+                group = g[1] + group
+                groups.remove(g)
+        groups.append((box, group))
+    return [g[1] for g in groups]
+
+
+def subset_file(jobs):
+    """
+    Extracts the subsets described by `jobs` (dictionaries prepared by
+    `subgeotiff` for the same file) and writes each of them to its
+    `job['fname']`, building its overviews if requested. The file is opened
+    once and the subsets are read in groups of overlapping windows (see
+    `overlap_groups`): the window enclosing each group is copied in strips of
+    rows aligned with the blocks of the input file, so that no more than
+    `job['max_mem']` MB are read at once.
+    The function can run in a worker process: it returns `None` on success
+    or the error message.
+    """
+    f = jobs[0]['file']
+    ndv = jobs[0]['ndv']
+    dtyp = jobs[0]['dtype']
+    ndval = jobs[0]['ndval']
+    max_mem = jobs[0]['max_mem']
+
+    print "\nSubsetting: {0}".format(f)
+    fin = gdal.Open(f)
+    bndin = fin.GetRasterBand(1)
+
+    # Check if we need to change the no-data value
+    remap = ndval and ndval != ndv
+    if remap:
+        ndv_in = ndv
+        ndv = ndval
+
+    for group in overlap_groups(jobs):
+        # Window enclosing all the subsets of the group
+        sc = min(j['window'][0] for j in group)
+        sr = min(j['window'][1] for j in group)
+        ec = max(j['window'][0] + j['window'][2] for j in group)
+        er = max(j['window'][1] + j['window'][3] for j in group)
+
+        # Rows boundaries of the strips to copy
+        rows = [sr, er]
+        if max_mem:
+            blk_y = bndin.GetBlockSize()[1]
+            row_size = (ec - sc) * np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(dtyp)).itemsize
+            strip = max(1, int(max_mem * 2 ** 20) // (row_size * blk_y)) * blk_y
+            rows[1:1] = range((sr // strip + 1) * strip, er, strip)
+
+        outs = []
+        for job in group:
+            jsc, jsr, coutsize, routsize = job['window']
+            out = {'job': job, 'band': None, 'np': None, 'stats': bandstats(ndv, job['stats_step'])}
+            fname = job['fname']
+            if fname is not None:
+                print "- Creating subset raster file: {0}".format(fname)
+                driver = gdal.GetDriverByName(job['format'])
+                fout = driver.Create(fname, coutsize, routsize, 1, dtyp, job['options'])
+                if not fout:
+                    outs = None
+                    bndin = None
+                    fin = None
+                    return "\nERROR -> error creating output file '{0}'".format(fname)
+                print "- Writing output file properties"
+                fout.SetProjection(job['proj'])
+                fout.SetMetadata(job['metadata'])
+                outgeo = list(job['geo'])
+                outgeo[0] += jsc * outgeo[1]
+                outgeo[3] += jsr * outgeo[5]
+                print "  - Output geotransform: {0}".format(outgeo)
+                fout.SetGeoTransform(outgeo)
+                out['file'] = fout
+                out['band'] = fout.GetRasterBand(1)
+
+            # Check if we are creating the numpy array
+            if job['npout']:
+                print "- Adding to numpy array {0}".format(job['npout'][0])
+                out['np'] = np.lib.format.open_memmap(job['npout'][0], mode='r+')
+            outs.append(out)
+
+        print "- Copying input raster subset ({0} subset(s), {1} strip(s))".format(len(group), len(rows) - 1)
+        for r0, r1 in zip(rows[:-1], rows[1:]):
+            datin = bndin.ReadAsArray(sc, r0, ec - sc, r1 - r0)
+            if remap:
+                datin[datin == ndv_in] = ndval
+            for out in outs:
+                jsc, jsr, coutsize, routsize = out['job']['window']
+                # Rows of the strip within the subset
+                s0 = max(r0, jsr)
+                s1 = min(r1, jsr + routsize)
+                if s0 >= s1:
+                    continue
+                datout = datin[s0 - r0:s1 - r0, jsc - sc:jsc - sc + coutsize]
+                if out['job']['mask'] is not None:
+                    datout = np.where(out['job']['mask'][s0 - jsr:s1 - jsr], datout, ndv).astype(datout.dtype)
+                if out['np'] is not None:
+                    np_file, np_idx, np_cube = out['job']['npout']
+                    out['np'].reshape(np_cube)[s0 - jsr:s1 - jsr, :, np_idx] = datout
+                if out['band'] is not None:
+                    out['stats'].update(datout)
+                    out['band'].WriteArray(datout, 0, s0 - jsr)
+            datin = None
+
+        for out in outs:
+            if out['np'] is not None:
+                out['np'].flush()
+                out['np'] = None
+
+            if out['band'] is not None:
+                print "- Writing output raster band properties: {0}".format(out['job']['fname'])
+                out['band'].SetNoDataValue(ndv)
+                print "  - Writing new statistics."
+                if out['stats'].count:
+                    out['band'].SetMetadata(out['stats'].metadata())
+                else:
+                    print "\nWARNING -> no valid pixels in the subset '{0}' of '{1}'".format(out['job']['fname'], f)
+
+        # Close the subsets of the group
+        out = None
+        outs = None
+        fout = None
+
+    print "- Flushing and closing files"
+    bndin = None
+    fin = None
+
+    # Overviews of the closed subsets
+    for job in jobs:
+        if job['fname'] is not None and job['overviews']:
+            err = build_overviews(job['fname'], job['overviews'])
+            if err:
+                return err
+
+
+def write_vrt(fname, jobs, ndval):
+    """
+    Writes a VRT file referencing the subsets described by `jobs` (one band
+    for each job) within the original files, without copying any pixel. The
+    subsets are expected to share the size and the georeferencing of the
+    first one. If `ndval` is defined, the original no-data values are mapped
+    to it (it is the no-data value of the bands without one).
+    """
+    sc, sr, coutsize, routsize = jobs[0]['window']
+    outgeo = list(jobs[0]['geo'])
+    outgeo[0] += sc * outgeo[1]
+    outgeo[3] += sr * outgeo[5]
+
+    vrt = ET.Element('VRTDataset', rasterXSize=str(coutsize), rasterYSize=str(routsize))
+    ET.SubElement(vrt, 'SRS').text = jobs[0]['proj']
+    ET.SubElement(vrt, 'GeoTransform').text = ', '.join(repr(float(g)) for g in outgeo)
+    if len(jobs) == 1:
+        mtd = ET.SubElement(vrt, 'Metadata')
+        for k, v in jobs[0]['metadata'].items():
+            ET.SubElement(mtd, 'MDI', key=k).text = v
+
+    for n, job in enumerate(jobs):
+        sc, sr, coutsize, routsize = job['window']
+        ndv = job['ndv']
+        band = ET.SubElement(vrt, 'VRTRasterBand', dataType=gdal.GetDataTypeName(job['dtype']), band=str(n + 1))
+        if len(jobs) > 1:
+            ET.SubElement(band, 'Description').text = basename(job['file'])
+            mtd = ET.SubElement(band, 'Metadata')
+            for k, v in job['metadata'].items():
+                ET.SubElement(mtd, 'MDI', key=k).text = v
+        if ndval and ndv is not None and ndval != ndv:
+            # The source no-data pixels are skipped, leaving the new value
+            ET.SubElement(band, 'NoDataValue').text = repr(ndval)
+            src = ET.SubElement(band, 'ComplexSource')
+        else:
+            # Without a source no-data value, the new one is only declared,
+            # as done for the GeoTIFF subsets
+            if ndv is not None:
+                ET.SubElement(band, 'NoDataValue').text = repr(ndv)
+            elif ndval:
+                ET.SubElement(band, 'NoDataValue').text = repr(ndval)
+            src = ET.SubElement(band, 'SimpleSource')
+        ET.SubElement(src, 'SourceFilename', relativeToVRT='0').text = abspath(job['file'])
+        ET.SubElement(src, 'SourceBand').text = '1'
+        ET.SubElement(src, 'SrcRect', xOff=str(sc), yOff=str(sr), xSize=str(coutsize), ySize=str(routsize))
+        ET.SubElement(src, 'DstRect', xOff='0', yOff='0', xSize=str(coutsize), ySize=str(routsize))
+        if src.tag == 'ComplexSource':
+            ET.SubElement(src, 'NODATA').text = repr(ndv)
+
+    with open(fname, 'w') as fil:
+        fil.write(ET.tostring(vrt))
+
+
+def write_stack(fname, jobs, interleave, options, ndval, max_mem, stats_step, npout=None, overviews=None):
+    """
+    Writes the subsets described by `jobs` (sharing the size of the first
+    one) as the bands of the single GeoTIFF `fname`, using the creation
+    `options` and the 'band' or 'pixel' `interleave`. All the input files are
+    read one strip of rows at a time (aligned with the output blocks and
+    within `max_mem` MB), so that each output block is written once. Each
+    band is described by the input file name and carries its metadata, the
+    acquisition DATE (from the file name when missing) and its statistics.
+    If `npout` is defined as (file, cube shape), the bands are also stored
+    in the numpy array. If `overviews` is defined, they are built as
+    described in `build_overviews`.
+    """
+    sc, sr, coutsize, routsize = jobs[0]['window']
+    np_type = np.result_type(*[gdal_array.GDALTypeCodeToNumericTypeCode(j['dtype']) for j in jobs])
+    dtyp = gdal_array.NumericTypeCodeToGDALTypeCode(np_type)
+
+    print "\nCreating subset stack file: {0} ({1} bands, {2} interleave)".format(fname, len(jobs), interleave)
+    driver = gdal.GetDriverByName(jobs[0]['format'])
+    fout = driver.Create(fname, coutsize, routsize, len(jobs), dtyp, options + ['INTERLEAVE={0}'.format(interleave.upper())])
+    if not fout:
+        exit("\nERROR -> error creating output file '{0}'".format(fname))
+    fout.SetProjection(jobs[0]['proj'])
+    outgeo = list(jobs[0]['geo'])
+    outgeo[0] += sc * outgeo[1]
+    outgeo[3] += sr * outgeo[5]
+    print "  - Output geotransform: {0}".format(outgeo)
+    fout.SetGeoTransform(outgeo)
+
+    # Rows boundaries of the strips, aligned with the output blocks (one row
+    # of blocks if no memory limit is given)
+    blk_y = fout.GetRasterBand(1).GetBlockSize()[1]
+    strip = blk_y
+    if max_mem:
+        row_size = coutsize * len(jobs) * np_type.itemsize
+        strip = max(1, int(max_mem * 2 ** 20) // (row_size * blk_y)) * blk_y
+    rows = range(0, routsize, strip) + [routsize]
+
+    bands = []
+    for n, job in enumerate(jobs):
+        fin = gdal.Open(job['file'])
+        ndv = job['ndv']
+        remap = ndval and ndval != ndv
+        stats = bandstats(ndval if remap else ndv, stats_step)
+        bands.append((fin, fin.GetRasterBand(1), remap, stats))
+
+    np_out = None
+    if npout:
+        np_out = np.lib.format.open_memmap(npout[0], mode='r+').reshape(npout[1])
+
+    for r0, r1 in zip(rows[:-1], rows[1:]):
+        print "- Copying rows {0} - {1}".format(r0, r1)
+        for n, job in enumerate(jobs):
+            fin, bndin, remap, stats = bands[n]
+            jsc, jsr = job['window'][:2]
+            datout = bndin.ReadAsArray(jsc, jsr + r0, coutsize, r1 - r0)
+            if remap:
+                datout[datout == job['ndv']] = ndval
+            if job['mask'] is not None:
+                datout = np.where(job['mask'][r0:r1], datout, stats.ndv).astype(datout.dtype)
+            if np_out is not None:
+                np_out[r0:r1, :, n] = datout
+            stats.update(datout)
+            fout.GetRasterBand(n + 1).WriteArray(datout, 0, r0)
+        datout = None
+
+    if np_out is not None:
+        np_out = None
+
+    print "- Writing output raster bands properties"
+    for n, job in enumerate(jobs):
+        fin, bndin, remap, stats = bands[n]
+        bndout = fout.GetRasterBand(n + 1)
+        bndout.SetDescription(basename(job['file']))
+        metadata = dict(job['metadata'])
+        if not [k for k in metadata if 'DATE' in k.upper()]:
+            date = re.search('[0-9]{8}', basename(job['file']))
+            if date:
+                metadata['DATE'] = date.group(0)
+        metadata.update(stats.metadata())
+        bndout.SetMetadata(metadata)
+        if stats.ndv is not None:
+            bndout.SetNoDataValue(stats.ndv)
+        bndout = None
+
+    print "- Flushing and closing files"
+    bands = None
+    fout = None
+
+    if overviews:
+        err = build_overviews(fname, overviews)
+        if err:
+            exit(err)
 
-def subgeotiff(data_in, data_out, bbox, prj_epsg, prj_url, dest_dir, overwrite, npout, ndval):
+
+def subgeotiff(data_in, data_out, bbox, prj_epsg, prj_url, dest_dir, overwrite, npout, ndval, workers=1, vrt=None, max_mem=None, stats_step=1, profile='default', aoi_file=None, cut_file=None, stack=None, check_grid=False, overviews=None, ovr_resampling='average'):
     # Check if the input data exists
     files = glob(data_in)
     if not files:
@@ -55,17 +505,8 @@ def subgeotiff(data_in, data_out, bbox, prj_epsg, prj_url, dest_dir, overwrite,
 
     print "\n{0} files selected using '{1}'".format(len(files), data_in)
 
-    # Check if we need to create an output directory
-    if dest_dir:
-        if overwrite:
-            try:
-                rmtree(data_out)
-            except OSError as e:
-                exit("\nERROR -> Removing directory {0} ({1})".format(data_out, e))
-        else:
-            if exists(data_out):
-                exit("\nERROR -> Directory already exists. Use -o to overwrite.")
-        makedirs(data_out)
+    if vrt and stack:
+        exit("\nERROR -> VRT and stack outputs cannot be combined")
 
     # Check for the range spatial reference
     if prj_epsg or prj_url:
@@ -85,31 +526,46 @@ def subgeotiff(data_in, data_out, bbox, prj_epsg, prj_url, dest_dir, overwrite,
         print "\nWARNING -> No spatial reference for range is defined! Using pixels!"
         rng_srs = None
 
-    # If not pixels, then create point geometries
-    if rng_srs:
-        if bbox:
-            [bbsl, bbst, bber, bbeb] = bbox
-            tl = ogr.Geometry(ogr.wkbPoint)
-            tl.AddPoint(bbsl, bbst)
-            br = ogr.Geometry(ogr.wkbPoint)
-            br.AddPoint(bber, bbeb)
-        else:
-            rng_srs = None
+    # The bounding boxes to extract: the named AOIs or the range
+    if aoi_file:
+        aois = read_aois(aoi_file, rng_srs)
+    else:
+        aois = [(None, bbox, rng_srs if bbox else None)]
+
+    # The polygons to crop to, in the range spatial reference if not defined.
+    # They are projected once for each projection and rasterized once for
+    # each grid and window.
+    cut_geom = None
+    if cut_file:
+        cut_geom, cut_srs = read_cutline(cut_file)
+        if cut_srs is None:
+            cut_srs = rng_srs
+        if ndval is None:
+            exit("\nERROR -> A no-data value (-n) is required to mask outside the cutline")
+        if vrt:
+            print "\nWARNING -> VRT files are cropped to the cutline envelope but not masked"
+        aois = [(None, None, None)]
+        cut_prj = {}
+        cut_masks = {}
+    pnt = ogr.Geometry(ogr.wkbPoint)
+    pnt.AddPoint(0, 0)
 
     # Create a spatial reference object for the soruce images
     src_srs = osr.SpatialReference()
 
     # Prepare gdal for output
     data_format = "GTiff"
-    driver = gdal.GetDriverByName(data_format)
     print "\nOutput format set to '{0}'".format(data_format)
 
-    fout_cnt = 0
-
-    # Array to contain the numpy array
-    np_out = None
-
-    # Cycle through input stack
+    # Cycle through input stack to define the subsets of each file. The
+    # corners of the AOIs are transformed once for each projection and the
+    # windows are computed once for each grid (projection, geotransform and
+    # size) shared by the files.
+    jobs = []
+    corners = {}
+    windows = {}
+    grids = {}
+    grid_order = []
     for f in files:
         print "\nOpening: {0}".format(f)
         fin = gdal.Open(f)
@@ -121,141 +577,260 @@ def subgeotiff(data_in, data_out, bbox, prj_epsg, prj_url, dest_dir, overwrite,
         print "  - Input geotransform: {0}".format(ingeo)
         metadata = fin.GetMetadata()
 
-        # If coordinates
-        if rng_srs:
-            transf = osr.CoordinateTransformation(rng_srs, src_srs)
-            tl.SetPoint(0, bbsl, bbst)
-            tl.Transform(transf)
-            tl_coo = tl.GetPoint()
-            print "    - top left: {0} -> {1}".format((bbsl, bbst), tl_coo)
-            br.SetPoint(0, bber, bbeb)
-            br.Transform(transf)
-            br_coo = br.GetPoint()
-            print "    - bottom right: {0} -> {1}".format((bber, bbeb), br_coo)
-            sr = int((tl_coo[1] - ingeo[3])/ingeo[5])
-            sc = int((tl_coo[0] - ingeo[0])/ingeo[1])
-            er = int((br_coo[1] - ingeo[3])/ingeo[5])
-            ec = int((br_coo[0] - ingeo[0])/ingeo[1])
-            ranges = True
-        else:  # If pixels range
-            if bbox:
-                [sc, sr, ec, er] = [int(r) for r in bbox]
-                ranges = True
-            else:
-                print "\nWARNING -> Range not defined. Creating a copy of input."
-                ranges = False
-
-        if ranges:
-            # Check range parameters
-            if sr < 0 or sc < 0 or er < 0 or ec < 0:
-                exit("\nERROR -> Pixel range values should be positive")
-            if er == sr or ec == sc:
-                exit("\nERROR -> Pixel range should be greater than zero")
-            if er < sr:
-                print("\nWARNING -> start row ({0}) larger then end row ({1}). Swapping.".format(sr, er))
-                sr, er = er, sr
-            if ec < sc:
-                print("\nWARNING -> start col ({0}) larger then end col ({1}). Swapping.".format(sc, ec))
-                sc, ec = ec, sc
-            print "    - Using pixel range: ({0}, {1}) -> ({2}, {3})".format(sr, sc, er, ec)
-            routsize = er - sr
-            coutsize = ec - sc
-
         print "- Reading input raster band properties"
         bndin = fin.GetRasterBand(1)
         ndv = bndin.GetNoDataValue()
         dtyp = bndin.DataType
         rinsize = bndin.YSize
         cinsize = bndin.XSize
-        if ranges:
-            if routsize > rinsize:
-                print "\nWARNING -> row output size ({0}) larger than input size ({1}). Shrinking output to match.".format(routsize, rinsize)
-                er = rinsize
-                routsize = er - sr
-                print "           New limits ({0} - {1}).".format(sr, er)
-            if coutsize > cinsize:
-                print "\nWARNING -> col output size ({0}) larger than input size ({1}). Shrinking output to match.".format(coutsize, cinsize)
-                ec = cinsize
-                coutsize = ec - sc
-                print "           New limits ({0} - {1}).".format(sc, ec)
-        else:
-            sc = 0
-            sr = 0
-            coutsize, routsize = cinsize, rinsize
-        print "- Reading input raster subset"
-        datout = bndin.ReadAsArray(sc, sr, coutsize, routsize)
-
-        # Check if we need to change the no-data value
-        if ndval:
-            if ndval != ndv:
-                datout[datout == ndv] = ndval
-                ndv = ndval
-
-        # Check if we are creating the numpy array
-        if npout:
-            print "- Adding to numpy array "
-            if np_out is not None:
-                try:
-                    np_out = np.dstack((np_out, datout))
-                except ValueError:
-                    print "\WARNING -> Size of current stack image {0} not compatible with previous size {1}: skipping!".format(np.shape(datout), np.shape(np_out))
-                    pass
+        grid = (proj, tuple(ingeo), cinsize, rinsize)
+        if grid not in grids:
+            grids[grid] = []
+            grid_order.append(grid)
+        grids[grid].append(f)
+
+        for n, (name, box, box_srs) in enumerate(aois):
+            if name is not None:
+                print "  - AOI: {0}".format(name)
+            # The window only depends on the AOI and on the grid
+            if (n, grid) in windows:
+                sc, sr, coutsize, routsize = windows[(n, grid)]
+                print "    - Same grid as {0}: using pixel range ({1}, {2}) -> ({3}, {4})".format(grids[grid][0], sr, sc, sr + routsize, sc + coutsize)
             else:
-                np_out = datout
-
-        fname = data_out + "_{0:03d}.tif".format(fout_cnt)
-        if dest_dir:
-            fname = join(data_out, fname)
-        print "- Creating subset raster file: {0}".format(fname)
-        fout = driver.Create(fname, coutsize, routsize, 1, dtyp, ['COMPRESS=DEFLATE', 'PREDICTOR=3'])
-        if not fout:
-            bndin = None
-            fin = None
-            exit("\nERROR -> error creating output file '{0}'".format(fout))
-        print "- Writing output file properties"
-        bndout = fout.GetRasterBand(1)
-        fout.SetProjection(proj)
-        fout.SetMetadata(metadata)
-        outgeo = list(ingeo)
-        outgeo[0] += sc * outgeo[1]
-        outgeo[3] += sr * outgeo[5]
-        print "  - Output geotransform: {0}".format(outgeo)
-        fout.SetGeoTransform(outgeo)
-
-        print "- Writing output raster band properties"
-        bndout.SetNoDataValue(ndv)
-        print "  - Writing new statistics."
-        bomin = np.min(datout[datout != ndv])
-        bomax = np.max(datout[datout != ndv])
-        boavg = np.mean(datout[datout != ndv])
-        bostd = np.std(datout[datout != ndv])
-        bndout.SetMetadata({'STATISTICS_MAXIMUM': str(bomax),
-                            'STATISTICS_MINIMUM': str(bomin),
-                            'STATISTICS_MEAN': str(boavg),
-                            'STATISTICS_STDDEV': str(bostd)})
-        print "- Writing output raster"
-        bndout.WriteArray(datout)
-
-        print "- Flushing and closing files"
-        bndout = None
-        fout = None
+                # If cutline, use its envelope within the image
+                if cut_geom is not None:
+                    if proj not in cut_prj:
+                        cut_prj[proj] = cut_geom.Clone()
+                        if cut_srs is not None:
+                            cut_prj[proj].Transform(osr.CoordinateTransformation(cut_srs, src_srs))
+                    minx, maxx, miny, maxy = cut_prj[proj].GetEnvelope()
+                    sc = max(int(np.floor((minx - ingeo[0])/ingeo[1])), 0)
+                    ec = min(int(np.ceil((maxx - ingeo[0])/ingeo[1])), cinsize)
+                    sr = max(int(np.floor((maxy - ingeo[3])/ingeo[5])), 0)
+                    er = min(int(np.ceil((miny - ingeo[3])/ingeo[5])), rinsize)
+                    print "    - Cutline envelope: {0} -> {1}".format((minx, maxy), (maxx, miny))
+                    if ec <= sc or er <= sr:
+                        exit("\nERROR -> The cutline does not overlap {0}".format(f))
+                    ranges = True
+                # If coordinates
+                elif box_srs:
+                    [bbsl, bbst, bber, bbeb] = box
+                    if (n, proj) not in corners:
+                        transf = osr.CoordinateTransformation(box_srs, src_srs)
+                        pnt.SetPoint(0, bbsl, bbst)
+                        pnt.Transform(transf)
+                        tl_coo = pnt.GetPoint()
+                        pnt.SetPoint(0, bber, bbeb)
+                        pnt.Transform(transf)
+                        br_coo = pnt.GetPoint()
+                        corners[(n, proj)] = (tl_coo, br_coo)
+                    tl_coo, br_coo = corners[(n, proj)]
+                    print "    - top left: {0} -> {1}".format((bbsl, bbst), tl_coo)
+                    print "    - bottom right: {0} -> {1}".format((bber, bbeb), br_coo)
+                    sr = int((tl_coo[1] - ingeo[3])/ingeo[5])
+                    sc = int((tl_coo[0] - ingeo[0])/ingeo[1])
+                    er = int((br_coo[1] - ingeo[3])/ingeo[5])
+                    ec = int((br_coo[0] - ingeo[0])/ingeo[1])
+                    ranges = True
+                else:  # If pixels range
+                    if box:
+                        [sc, sr, ec, er] = [int(r) for r in box]
+                        ranges = True
+                    else:
+                        print "\nWARNING -> Range not defined. Creating a copy of input."
+                        ranges = False
+
+                if ranges:
+                    # Check range parameters
+                    if sr < 0 or sc < 0 or er < 0 or ec < 0:
+                        exit("\nERROR -> Pixel range values should be positive")
+                    if er == sr or ec == sc:
+                        exit("\nERROR -> Pixel range should be greater than zero")
+                    if er < sr:
+                        print("\nWARNING -> start row ({0}) larger then end row ({1}). Swapping.".format(sr, er))
+                        sr, er = er, sr
+                    if ec < sc:
+                        print("\nWARNING -> start col ({0}) larger then end col ({1}). Swapping.".format(sc, ec))
+                        sc, ec = ec, sc
+                    print "    - Using pixel range: ({0}, {1}) -> ({2}, {3})".format(sr, sc, er, ec)
+                    routsize = er - sr
+                    coutsize = ec - sc
+
+                    if routsize > rinsize:
+                        print "\nWARNING -> row output size ({0}) larger than input size ({1}). Shrinking output to match.".format(routsize, rinsize)
+                        er = rinsize
+                        routsize = er - sr
+                        print "           New limits ({0} - {1}).".format(sr, er)
+                    if coutsize > cinsize:
+                        print "\nWARNING -> col output size ({0}) larger than input size ({1}). Shrinking output to match.".format(coutsize, cinsize)
+                        ec = cinsize
+                        coutsize = ec - sc
+                        print "           New limits ({0} - {1}).".format(sc, ec)
+                else:
+                    sc = 0
+                    sr = 0
+                    coutsize, routsize = cinsize, rinsize
+                windows[(n, grid)] = (sc, sr, coutsize, routsize)
+            mask = None
+            if cut_geom is not None:
+                if grid not in cut_masks:
+                    print "    - Rasterizing cutline mask"
+                    cut_masks[grid] = cutline_mask(cut_prj[proj], ingeo, (sc, sr, coutsize, routsize))
+                mask = cut_masks[grid]
+            jobs.append({'file': f,
+                         'aoi': name,
+                         'mask': mask,
+                         'proj': proj,
+                         'geo': ingeo,
+                         'metadata': metadata,
+                         'ndv': ndv,
+                         'dtype': dtyp,
+                         'window': (sc, sr, coutsize, routsize)})
         bndin = None
         fin = None
 
-        fout_cnt += 1
-    # If we have defined geometries, destroy them
-    if rng_srs:
-        tl.Destroy()
-        br.Destroy()
+    pnt.Destroy()
+
+    # Flag the files not sharing the grid of the first one
+    if len(grid_order) > 1:
+        print "\nWARNING -> The stack is not co-registered ({0} different grids):".format(len(grid_order))
+        for grid in grid_order:
+            print "  - Geotransform {0}, size {1} ({2} files): {3}".format(list(grid[1]), grid[2:], len(grids[grid]), ", ".join(basename(g) for g in grids[grid]))
+        if check_grid:
+            exit("\nERROR -> All the files of the stack should share the same grid")
+    elif check_grid:
+        print "\nAll the files of the stack share the same grid"
+
+    # All the bands of a GeoTIFF stack share the same no-data value
+    if stack and not ndval:
+        ndvs = sorted(set(j['ndv'] for j in jobs))
+        if len(ndvs) > 1:
+            exit("\nERROR -> The files of the stack have different no-data values ({0}): use -n to set the one of the stack".format(", ".join(str(v) for v in ndvs)))
+
+    # Check if we need to create an output directory, only once the stack
+    # has been validated and before writing the first output
+    if dest_dir:
+        if overwrite:
+            try:
+                rmtree(data_out)
+            except OSError as e:
+                exit("\nERROR -> Removing directory {0} ({1})".format(data_out, e))
+        else:
+            if exists(data_out):
+                exit("\nERROR -> Directory already exists. Use -o to overwrite.")
+        makedirs(data_out)
+
+    # Overviews to build after writing each GeoTIFF
+    ovr_def = (overviews, ovr_resampling) if overviews else None
+
+    # Define the outputs of each AOI, named after 'data_out' and the AOI name
+    for name, box, box_srs in aois:
+        aoi_jobs = [j for j in jobs if j['aoi'] == name]
+        base_out = data_out if name is None else "{0}_{1}".format(data_out, name)
+
+        # If we want the array, preallocate it as a memory mapped .npy file.
+        # Only the subsets with the same size of the first one are stacked.
+        if npout:
+            np_size = aoi_jobs[0]['window'][2:]
+            np_jobs = [j for j in aoi_jobs if j['window'][2:] == np_size]
+            for j in aoi_jobs:
+                if j['window'][2:] != np_size:
+                    print "\nWARNING -> Size of stack image {0} {1} not compatible with first size {2}: skipping!".format(j['file'], (j['window'][3], j['window'][2]), (np_size[1], np_size[0]))
+            np_type = np.result_type(*[gdal_array.GDALTypeCodeToNumericTypeCode(j['dtype']) for j in np_jobs])
+            fname = base_out + ".npy"
+            if dest_dir:
+                fname = join(data_out, fname)
+            print "\nCreating numpy array {0} ({1}, {2} images)".format(fname, np_type, len(np_jobs))
+            np_shape = (np_size[1], np_size[0], len(np_jobs))
+            if len(np_jobs) == 1:
+                np_shape = np_shape[:2]
+            # The subsets are written into the file by 'subset_file'
+            np.lib.format.open_memmap(fname, mode='w+', dtype=np_type, shape=np_shape).flush()
+            np_file = fname
+            np_cube = (np_size[1], np_size[0], len(np_jobs))
+            np_index = dict((j['file'], n) for n, j in enumerate(np_jobs))
+
+        # If requested, reference the subsets through VRT files
+        if vrt == "files":
+            for fout_cnt, job in enumerate(aoi_jobs):
+                fname = base_out + "_{0:03d}.vrt".format(fout_cnt)
+                if dest_dir:
+                    fname = join(data_out, fname)
+                print "\nCreating subset VRT file: {0}".format(fname)
+                write_vrt(fname, [job], ndval)
+        elif vrt == "stack":
+            vrt_size = aoi_jobs[0]['window'][2:]
+            vrt_jobs = [j for j in aoi_jobs if j['window'][2:] == vrt_size]
+            for j in aoi_jobs:
+                if j['window'][2:] != vrt_size:
+                    print "\nWARNING -> Size of stack image {0} {1} not compatible with first size {2}: skipping!".format(j['file'], (j['window'][3], j['window'][2]), (vrt_size[1], vrt_size[0]))
+            fname = base_out + ".vrt"
+            if dest_dir:
+                fname = join(data_out, fname)
+            print "\nCreating subset VRT stack: {0} ({1} bands)".format(fname, len(vrt_jobs))
+            write_vrt(fname, vrt_jobs, ndval)
+
+        # If requested, write the subsets with the same size of the first one
+        # as the bands of a single file
+        if stack:
+            stack_size = aoi_jobs[0]['window'][2:]
+            stack_jobs = [j for j in aoi_jobs if j['window'][2:] == stack_size]
+            for j in aoi_jobs:
+                if j['window'][2:] != stack_size:
+                    print "\nWARNING -> Size of stack image {0} {1} not compatible with first size {2}: skipping!".format(j['file'], (j['window'][3], j['window'][2]), (stack_size[1], stack_size[0]))
+            for j in stack_jobs:
+                j['format'] = data_format
+            fname = base_out + ".tif"
+            if dest_dir:
+                fname = join(data_out, fname)
+            stack_type = np.result_type(*[gdal_array.GDALTypeCodeToNumericTypeCode(j['dtype']) for j in stack_jobs])
+            write_stack(fname, stack_jobs, stack, gtiff_options(stack_type, profile), ndval, max_mem, stats_step, (np_file, np_cube) if npout else None, ovr_def)
+            continue
+
+        # Define the output of each subset following the order of the input stack
+        for fout_cnt, job in enumerate(aoi_jobs):
+            fname = base_out + "_{0:03d}.tif".format(fout_cnt)
+            if dest_dir:
+                fname = join(data_out, fname)
+            # No GeoTIFF is created when using VRT files
+            job['fname'] = None if vrt else fname
+            job['format'] = data_format
+            # Parallel workers already share the CPUs
+            job['options'] = gtiff_options(job['dtype'], profile, threads=1 if workers > 1 else None)
+            job['ndval'] = ndval
+            job['max_mem'] = max_mem
+            job['stats_step'] = stats_step
+            job['overviews'] = ovr_def
+            job['npout'] = None
+            if npout and job['file'] in np_index:
+                job['npout'] = (np_file, np_index[job['file']], np_cube)
+
+    # When using VRT files, the pixels are only read to create the numpy array
+    if vrt:
+        jobs = [j for j in jobs if j['npout']]
+    # The stack files (and the numpy arrays) are already written
+    elif stack:
+        jobs = []
+
+    # Each file is opened once, reading overlapping subsets together
+    tasks = [[j for j in jobs if j['file'] == f] for f in files]
+    tasks = [t for t in tasks if t]
+
+    # Create the subsets, in parallel if requested
+    if workers > 1:
+        print "\nSubsetting {0} files using {1} processes".format(len(files), workers)
+        pool = Pool(workers)
+        try:
+            errors = pool.map(subset_file, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = map(subset_file, tasks)
+    for e in errors:
+        if e:
+            exit(e)
 
-    # If we want the array, save it
-    if npout:
-        print "- Saving numpy array"
-        fname = data_out + ".npy"
-        if dest_dir:
-            fname = join(data_out, fname)
-        with open(fname, 'w') as fil:
-            np.save(fil, np_out)
 
 if __name__ == "__main__":
     # If it is used as a script, parse the arguments
@@ -318,11 +893,90 @@ if __name__ == "__main__":
                         location specified by the '-d' (or '--dir'). The file \
                         will include the 3D 'npout' array coposed by stacking \
                         along the 3rd dimension the GeoTIFF subsets. The array \
-                        will only stack subset of equal size.")
+                        is preallocated and only stacks the subsets with the \
+                        same size of the first one.")
     parser.add_argument("-n", "--ndval",
                         type=float,
                         help="When defined, sets the new 'no-data-value' for \
                         the generated substack. (Default: '%(default)s').")
+    parser.add_argument("--vrt",
+                        choices=("files", "stack"),
+                        help="Instead of GeoTIFF files, create VRT files \
+                        referencing the subsets within the input files \
+                        without copying any pixel. 'files' creates one VRT \
+                        for each input file (numbered as the GeoTIFF files), \
+                        'stack' creates a single multi-band VRT named after \
+                        'data_out' including the subsets with the same size \
+                        of the first one.")
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=1,
+                        help="Number of processes used to subset the files \
+                        of the stack in parallel. The output numbering still \
+                        follows the order of the input stack. \
+                        (Default: '%(default)s').")
+    parser.add_argument("-m", "--max_mem",
+                        type=float,
+                        help="Memory budget (in MB) used to copy each subset. \
+                        When defined, the subsets are copied in strips of \
+                        rows aligned with the blocks of the input files \
+                        instead of reading the whole window at once. \
+                        (Default: '%(default)s').")
+    parser.add_argument("-s", "--stats_step",
+                        type=int,
+                        default=1,
+                        help="Compute approximate statistics of the subsets \
+                        using only one pixel every 'stats_step' rows and \
+                        columns. (Default: '%(default)s').")
+    parser.add_argument("-g", "--profile",
+                        choices=sorted(PROFILES),
+                        default="default",
+                        help="GeoTIFF creation profile of the subsets: \
+                        'fast-write' (ZSTD level 1), 'small' (DEFLATE level \
+                        9), 'fast-random-read' (LZW, small tiles). All the \
+                        profiles create tiled files compressed using multiple \
+                        threads with a predictor chosen from the data type. \
+                        (Default: '%(default)s').")
+    parser.add_argument("-b", "--aoi",
+                        help="File listing named bounding boxes (AOIs) to \
+                        extract in a single pass over the stack, one per \
+                        line as 'name east north west south [srs]', where \
+                        'srs' is 'EPSG:<code>', a spatial reference URL or \
+                        'pixels' (default: the '-p' or '-u' reference). The \
+                        outputs of each AOI are named appending the AOI name \
+                        to 'data_out'. Overrides '-r (--range)'.")
+    parser.add_argument("-c", "--cutline",
+                        help="Polygon layer (shapefile or any OGR format) used \
+                        to crop the subsets: each output is limited to the \
+                        envelope of the polygons and the pixels outside them \
+                        are set to the no-data value defined with '-n' \
+                        (required). Without a spatial reference, the layer is \
+                        interpreted using '-p' or '-u'. Overrides '-r' and \
+                        '-b'.")
+    parser.add_argument("--stack",
+                        choices=("band", "pixel"),
+                        help="Write the subsets with the same size of the \
+                        first one as the bands of a single GeoTIFF named \
+                        after 'data_out', each band carrying the date and \
+                        statistics of its subset. 'band' interleave favours \
+                        reading one date at a time, 'pixel' interleave \
+                        reading the time series of a pixel. Requires '-n' \
+                        if the files have different no-data values.")
+    parser.add_argument("--check_grid",
+                        action="store_true",
+                        help="Stop before writing any output if the files of \
+                        the stack do not share the same projection, \
+                        geotransform and size (default: 'False').")
+    parser.add_argument("--overviews",
+                        choices=("internal", "external"),
+                        help="Build the overviews of each GeoTIFF right after \
+                        writing it, within the file or as an external .ovr \
+                        file (in parallel when using '-w').")
+    parser.add_argument("--ovr_resampling",
+                        choices=("nearest", "average", "gauss", "cubic", "mode"),
+                        default="average",
+                        help="Resampling method used to build the overviews. \
+                        (Default: '%(default)s').")
 
     args = parser.parse_args()
 
@@ -335,6 +989,17 @@ if __name__ == "__main__":
                args.dir,
                args.overwrite,
                args.npout,
-               args.ndval)
+               args.ndval,
+               args.workers,
+               args.vrt,
+               args.max_mem,
+               args.stats_step,
+               args.profile,
+               args.aoi,
+               args.cutline,
+               args.stack,
+               args.check_grid,
+               args.overviews,
+               args.ovr_resampling)
 
 
@@ -3,20 +3,26 @@
 Created on Sun Apr  5 20:35:21 2015
 Name:    xls2gdb.py
 Purpose: Convert VDOT 10th mile road condition XLS files into ESRI shapefile
-         where each feature can be either a point, a line, a buffered line or
-         polygon (rectangle) with extents identified by the GPS start/stop
-         latitude/longitude coordinates stored in the excel file.
+         (or GeoPackage/FlatGeobuf) where each feature can be either a point,
+         a line, a buffered line or polygon (rectangle) with extents
+         identified by the GPS start/stop latitude/longitude coordinates
+         stored in the excel file. Several sheets and files can be
+         converted at once, each into its own layer, and the lines of each
+         route can be dissolved into measured polylines.
 Author:  Andrea Vaccari (av9g@virginia.edu)
 Version: 1.0.0
 """
 
-from os.path import exists
+from os.path import exists, basename, splitext
 from sys import exit, stdout
+from glob import glob
+from multiprocessing import Pool
 import argparse
+import re
 
 
 try:
-    from pandas import read_excel
+    from pandas import read_excel, factorize, DataFrame
 except ImportError:
     exit("\nERROR -> Pandas required to read excel XLS files")
 
@@ -30,117 +36,564 @@ try:
 except ImportError:
     exit("\nERROR -> Osgeo/osr required to create shapefile")
 
+try:
+    import numpy as np
+except ImportError:
+    exit("\nERROR -> Numpy required")
+
+try:
+    from prjpnt import prjpnt
+except ImportError:
+    exit("\nERROR -> prjpnt required to handle projections")
+
+
+FIELD_NAME_MAPPING = {
+    "VDOT System ID":                                           "VDOTSysId",
+    "District":                                                 "District",
+    "County (Maint. Jurisd.)":                                  "CntyMntJr",
+    "LM's Invalid IRI":                                         "LMInvdIRI",
+    "Year":                                                     "Year",
+    "Link to External Information":                             "LnkExtInf",
+    "Pavement Type":                                            "PvmntType",
+    "Divided Flag":                                             "DivdFlag",
+    "Number of Travel Lanes":                                   "TrvlLnNmb",
+    "Lane Miles":                                               "LaneMiles",
+    "Pavement Type Code":                                       "PvmTypCod",
+    "Lane Width":                                               "LaneWidth",
+    "LDR":                                                      "LDR",
+    "NDR":                                                      "NDR",
+    "Deficient Lane Mileage":                                   "DefLanMil",
+    "LM's Valid IRI":                                           "LMValdIRI",
+    "S_Rut (in)":                                               "SRut_in",
+    "NIRI Average":                                             "NIRI_Avrg",
+    "IRI Left WP":                                              "IRILftWp",
+    "IRI Right WP":                                             "IRIRigWp",
+    "LM's Excellent IRI (0-59)":                                "LMExclIRI",
+    "LM's Good IRI (60-99)":                                    "LMGoodIRI",
+    "LM's Fair IRI (100-139)":                                  "LMFairIRI",
+    "LM's Poor IRI (140-199)":                                  "LMPoorIRI",
+    "LM's Very Poor IRI (200+)":                                "LMVrPrIRI",
+    "LM's Excellent CCI (90-100)":                              "LMExclCCI",
+    "LM's Good CCI (70-89)":                                    "LMGoodCCI",
+    "LM's Fair CCI (60-69)":                                    "LMFairCCI",
+    "LM's Poor CCI (50-59)":                                    "LMPoorCCI",
+    "LM's Very Poor CCI (0-49)":                                "LMVrPrCCI",
+    "Reflective Transverse Cracking Severity 2 (lin ft)":       "RTCS2_lft",
+    "Transverse Cracking Severity 1(lin ft)":                   "TCS1_lft",
+    "Transverse Cracking Severity 2 (lin ft)":                  "TCS2_lft",
+    "Longitudinal Cracking Severity 1 (lin ft)":                "LCS1_lft",
+    "Longitudinal Cracking Severity 2 (lin ft)":                "LCS2_lft",
+    "Longitudinal Joint Severity 1 (lin ft)":                   "LJS1_lft",
+    "Longitudinal Joint Severity 2 (lin ft)":                   "LJS2_lft",
+    "Reflective Transverse Cracking Severity 1 (lin ft)":       "RTCS1_lft",
+    "W_Rut (in)":                                               "W_Rut_in",
+    "Reflective Transverse Cracking Severity 3 (lin ft)":       "RTCS3_lft",
+    "Reflective Longitudinal Cracking Severity 1 (lin ft)":     "RLCS1_lft",
+    "Reflective Longitudinal Cracking Severity 2 (lin ft)":     "RLCS2_lft",
+    "Reflective Longitudinal Cracking Severity 3 (lin ft)":     "RLCS3_lft",
+    "Distress Length":                                          "Dstrs_len",
+    "Length":                                                   "Length",
+    "Alligator Sev 1 (sf)":                                     "AgtrS1_sf",
+    "Alligator Sev 2 (sf)":                                     "AgtrS2_sf",
+    "Patching Area - Wheel Path (sf)":                          "PcAWP_sf",
+    "Alligator Sev 3 (sf)":                                     "AgtrS3_sf",
+    "Delamination Area (sf)":                                   "DelmnA_sf",
+    "Patching Area - Non Wheel Path (sf)":                      "PcANWP_sf",
+    "Route Name":                                               "RouteName",
+    "County From":                                              "CntyFrom",
+    "Direction":                                                "Direction",
+    "Lane":                                                     "Lane",
+    "Offset":                                                   "Offset",
+    "County Beg. Milepoint":                                    "CntyBgMPt",
+    "County To":                                                "CntyTo",
+    "County End Milepoint":                                     "CntyEdMPt",
+    "CCI":                                                      "CCI",
+    "Potholes (count)":                                         "PothlsCnt",
+    "Bleeding Sev. 1 (sf)":                                     "BldgS1_sf",
+    "Bleeding Sev. 2 (sf)":                                     "BldgS2_sf",
+    "No Distress Rated":                                        "NDstrsRat",
+    "Start GPS Latitude":                                       "StrGPSLat",
+    "Start GPS Longitude":                                      "StrGPSLng",
+    "End GPS Latitude":                                         "EndGPSLat",
+    "End GPS Longitude":                                        "EndGPSLng",
+    "Bridge Flag":                                              "BrdgFlag",
+    "Construction Flag":                                        "CnstrFlag",
+    "Lane Deviation Flag":                                      "LnDevFlag",
+    "Attachment":                                               "Attachmnt",
+    "Comments":                                                 "Comments",
+    "SECTIONKEY":                                               "SectnKey",
+    "Field-Recorded Pavement Type":                             "FldRcPvTy",
+    "Surface Type":                                             "SurfType",
+    "Date Tested":                                              "DateTest",
+    "Speed (mph)":                                              "Speed_mph",
+    "Traffic Level (1,2,3)":                                    "TrfcLevel",
+    "Number of Trucks":                                         "TrucksNo",
+    "State Owner":                                              "StateOwnr",
+    "Strong ? (FWD)":                                           "StrongFWD",
+    "Begin Landmark":                                           "BgnLndMrk",
+    "End Landmark":                                             "EndLndMrk",
+    "Section Length":                                           "SectnLen",
+    "Notes":                                                    "Notes",
+    "Roadware Divided":                                         "RdwrDivd",
+    "Roadware Rated Lanes":                                     "RdwrRatLn",
+    "Roadware LRS Change":                                      "RdwrLRSCh",
+    "Roadware LRS Change Code":                                 "RdwrLRSCC",
+    "Roadware Pavement Type":                                   "RdwrPvTyp",
+    "Roadware Review Date":                                     "RdwrRevDt",
+    "Last Rehab Year":                                          "LastRhbYr",
+    "Date/Time Updated":                                        "DatTimUpd",
+    "User Update":                                              "UsrUpdate",
+    "LRM Currency Date":                                        "LRMCurDat",
+    "LRM Version Number":                                       "LRMVerNum",
+    "Network Date":                                             "NetwkDate",
+    "Previous Loc Ident":                                       "PrvLocID",
+    "Repeat ?":                                                 "Repeat",
+    "VDOT Maintained?":                                         "VDOTMntnd",
+    # Fields of the 'points' features
+    "NSections":                                                "NSections",
+    "Sections":                                                 "Sections"}
+
+# Column identifying the sections referenced by the 'points' features (the
+# row numbers are used when missing)
+SECTION_KEY = "SECTIONKEY"
+
+FIELD_TYPE_MAPPING = {
+    "object":           ogr.OFTString,
+    "float64":          ogr.OFTReal,
+    "int64":            ogr.OFTInteger,
+    "datetime64[ns]":   ogr.OFTDateTime}
+
+# Output formats: OGR driver, layer creation options and whether the
+# field names have to be shortened to 10 characters
+OUTPUT_FORMATS = {
+    "shapefile":        ("ESRI Shapefile", [], True),
+    "gpkg":             ("GPKG", ["SPATIAL_INDEX=YES"], False),
+    "flatgeobuf":       ("FlatGeobuf", ["SPATIAL_INDEX=YES"], False)}
+
+# Extension of the output files holding a single layer (several layers are
+# written to a directory)
+SINGLE_LAYER_EXT = {
+    "shapefile":        ".shp",
+    "flatgeobuf":       ".fgb"}
+
+# Columns identifying the routes merged by the dissolve option (the county
+# is used when available, since the milepoints are relative to it) and
+# columns of the milepoints at the start/end of each section
+ROUTE_KEYS = ["County (Maint. Jurisd.)", "Route Name", "Direction", "Lane"]
+BEG_MILEPOINT = "County Beg. Milepoint"
+END_MILEPOINT = "County End Milepoint"
+
+# Largest gap (miles) between the milepoints of contiguous sections
+MILEPOINT_TOL = 0.001
+
+# Number of sides approximating each half circle of the round caps of the
+# buffered features (the flat caps have a single side)
+CAP_SEGMENTS = 8
+
+
+def buffered_rings(x, y, buflen, segments=1):
+    """
+    Returns the 2D arrays of the x and y coordinates of the rings (one row
+    for each geometry) buffering by `buflen` the segments whose start/end
+    coordinates are the two columns of `x` and `y`. Both ends are capped by
+    half circles approximated by `segments` sides: a single side gives the
+    flat caps of an oriented rectangle. All the rings have 2 * (`segments` +
+    1) vertices, listed counterclockwise.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    theta = np.arctan2(y[:, 1] - y[:, 0], x[:, 1] - x[:, 0])[:, np.newaxis]
+
+    # Cap around the end, from the right to the left side of the segment,
+    # followed by the cap around the start, from the left to the right side
+    steps = np.pi * np.arange(segments + 1) / segments
+    angles = np.hstack([theta - np.pi / 2 + steps, theta + np.pi / 2 + steps])
+    cx = np.repeat(x[:, ::-1], segments + 1, axis=1)
+    cy = np.repeat(y[:, ::-1], segments + 1, axis=1)
+    return cx + buflen * np.cos(angles), cy + buflen * np.sin(angles)
+
+
+def shared_vertices(x, y, tol):
+    """
+    Returns the indices of the unique vertices among the coordinates `x` and
+    `y`, snapped to a grid of spacing `tol`, and the list of the arrays of
+    the indices of the coordinates falling on each of them. The snapped
+    coordinates are hashed, so the cost grows linearly with their number.
+    """
+    if len(x) == 0:
+        return np.zeros(0, dtype=int), []
+
+    # Codes of the grid columns and rows, combined into the vertex codes
+    cols = factorize(np.floor(np.asarray(x) / tol).astype(np.int64))[0]
+    rows = factorize(np.floor(np.asarray(y) / tol).astype(np.int64))[0]
+    codes = factorize(cols * len(rows) + rows)[0]
+
+    # Coordinates grouped by vertex, the first of each group in input order
+    order = np.argsort(codes, kind="mergesort")
+    starts = np.cumsum(np.bincount(codes))[:-1]
+    groups = np.split(order, starts)
+    return order[np.r_[0, starts]], groups
+
+
+def dissolve_routes(xldata, x, y):
+    """
+    Merges the sections in `xldata`, whose start/end coordinates are the two
+    columns of `x` and `y`, into one feature for each route (`ROUTE_KEYS`).
+    The sections of a route are ordered by their starting milepoint and
+    each run of contiguous sections becomes a part of a measured polyline,
+    whose vertices have the milepoints as measures.
+    Returns the data frame of the routes (keys, number of sections and
+    start/end milepoints) and the list of the WKB strings of their geometries.
+    """
+    keys = [k for k in ROUTE_KEYS if k in xldata]
+    for col in ROUTE_KEYS[1:] + [BEG_MILEPOINT, END_MILEPOINT]:
+        if col not in xldata:
+            exit("\nERROR -> Column '{0}' required to dissolve the sections".format(col))
+
+    routes = xldata[keys].iloc[:0].copy()
+    routes["NSections"] = np.zeros(0, dtype=np.int64)
+    routes[BEG_MILEPOINT] = np.zeros(0)
+    routes[END_MILEPOINT] = np.zeros(0)
+    if len(xldata) == 0:
+        return routes, []
+
+    # Sort the sections by route and starting milepoint
+    route = np.zeros(len(xldata), dtype=np.int64)
+    for k in keys:
+        codes = factorize(xldata[k])[0] + 1  # Missing values have code -1
+        route = factorize(route * (len(codes) + 1) + codes)[0]
+    beg = xldata[BEG_MILEPOINT].values.astype(float)
+    end = xldata[END_MILEPOINT].values.astype(float)
+    order = np.lexsort((beg, route))
+    route, beg, end, x, y = route[order], beg[order], end[order], x[order], y[order]
+
+    # A new route, or a gap between the milepoints, starts a new part
+    new_route = np.r_[True, route[1:] != route[:-1]]
+    new_part = new_route | np.r_[True, ~(np.abs(beg[1:] - end[:-1]) <= MILEPOINT_TOL)]
+    route_starts = np.flatnonzero(new_route)
+    part_starts = np.flatnonzero(new_part)
+    route_stops = np.r_[route_starts[1:], len(route)]
+    part_stops = np.r_[part_starts[1:], len(route)]
+
+    # Each part has the start of its first section followed by the ends of
+    # all its sections
+    mline = np.dtype([('order', 'u1'), ('type', '<u4'), ('n_parts', '<u4')])
+    line = np.dtype([('order', 'u1'), ('type', '<u4'), ('n_pnts', '<u4')])
+    part_route = np.searchsorted(route_starts, part_starts, side='right') - 1
+    wkb = [[np.array([(1, ogr.wkbMultiLineStringM, 0)], dtype=mline)] for _ in route_starts]
+    for p_start, p_stop, r in zip(part_starts, part_stops, part_route):
+        coo = np.column_stack([np.r_[x[p_start, 0], x[p_start:p_stop, 1]],
+                               np.r_[y[p_start, 0], y[p_start:p_stop, 1]],
+                               np.r_[beg[p_start], end[p_start:p_stop]]])
+        wkb[r][0]['n_parts'] += 1
+        wkb[r].append(np.array([(1, ogr.wkbLineStringM, len(coo))], dtype=line))
+        wkb[r].append(coo.astype('<f8'))
+    wkb = ["".join(rec.tostring() for rec in recs) for recs in wkb]
+
+    routes = xldata[keys].iloc[order[route_starts]].reset_index(drop=True)
+    routes["NSections"] = route_stops - route_starts
+    routes[BEG_MILEPOINT] = beg[route_starts]
+    routes[END_MILEPOINT] = np.maximum.reduceat(end, route_starts)
+    return routes, wkb
+
+
+def wkb_geometries(geom, x, y):
+    """
+    Returns the (little endian) WKB records of 'points', 'lines' or
+    'polygons' `geom` geometries whose vertices are the columns of the 2D
+    arrays `x` and `y` (one row for each geometry). The rings of the polygons
+    are closed by repeating the first vertex.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if geom == "polygons":
+        x = np.hstack([x, x[:, :1]])
+        y = np.hstack([y, y[:, :1]])
+    n_geom, n_pnts = x.shape
+
+    if geom == "points":
+        wkb = np.zeros(n_geom, dtype=[('order', 'u1'), ('type', '<u4'), ('coo', '<f8', (2,))])
+        wkb['type'] = ogr.wkbPoint
+        wkb['coo'] = np.column_stack([x[:, 0], y[:, 0]])
+    elif geom == "lines":
+        wkb = np.zeros(n_geom, dtype=[('order', 'u1'), ('type', '<u4'), ('n_pnts', '<u4'), ('coo', '<f8', (n_pnts, 2))])
+        wkb['type'] = ogr.wkbLineString
+        wkb['n_pnts'] = n_pnts
+        wkb['coo'] = np.dstack([x, y])
+    else:
+        wkb = np.zeros(n_geom, dtype=[('order', 'u1'), ('type', '<u4'), ('n_rings', '<u4'), ('n_pnts', '<u4'), ('coo', '<f8', (n_pnts, 2))])
+        wkb['type'] = ogr.wkbPolygon
+        wkb['n_rings'] = 1
+        wkb['n_pnts'] = n_pnts
+        wkb['coo'] = np.dstack([x, y])
+    wkb['order'] = 1
+    return wkb
+
+
+def field_writers(xldata, labels, featDef, f_names):
+    """
+    Returns, for each column in `labels` of the data frame `xldata`, the
+    index of the field `f_names` in `featDef`, the typed setter of the field
+    and the list of the values to set. NaN/NaT values are `None`: their
+    fields are left unset, i.e. null.
+    """
+    set_int = getattr(ogr.Feature, 'SetFieldInteger64', ogr.Feature.SetField)
+    set_date = lambda feat, idx, val: feat.SetField(idx, *val)
+    writers = []
+    for l, f_name in zip(labels, f_names):
+        col = xldata[l]
+        null = col.isnull().values
+        kind = col.dtype.kind
+        if kind == 'f':
+            setter = ogr.Feature.SetFieldDouble
+            vals = col.tolist()
+        elif kind in 'iub':
+            setter = set_int
+            vals = [int(v) for v in col.values]
+        elif kind == 'M':
+            # Year, month, day, hour, minute, second and unknown time zone
+            setter = set_date
+            vals = [(t.year, t.month, t.day, t.hour, t.minute, t.second + t.microsecond * 1e-6, 0) if not n else None for t, n in zip(col.tolist(), null)]
+        else:
+            setter = ogr.Feature.SetField
+            vals = [v if isinstance(v, basestring) else str(v) for v in col.tolist()]
+        vals = [None if n else v for v, n in zip(vals, null)]
+        writers.append((featDef.GetFieldIndex(f_name), setter, vals))
+    return writers
+
+
+def layer_name(template, xls_file, sheet, xldata):
+    """
+    Returns the layer name defined by `template` for the `sheet` of
+    `xls_file`, replacing '{sheet}', '{name}' (base name of the file) and
+    '{year}' (most frequent value of the 'Year' column, or a 4-digit year in
+    the file name).
+    """
+    name = splitext(basename(xls_file))[0]
+    year = ""
+    if "Year" in xldata and xldata["Year"].notnull().any():
+        year = str(int(xldata["Year"].mode()[0]))
+    else:
+        match = re.search("(19|20)[0-9]{2}", name)
+        if match:
+            year = match.group(0)
+        elif "{year}" in template:
+            exit("\nERROR -> No year found for '{0}'/'{1}'".format(xls_file, sheet))
+    return template.format(year=year, sheet=sheet, name=name)
+
+
+def create_fields(lyr, xldata, short_names, source):
+    """
+    Creates in `lyr` a field for each column of `xldata` (read from
+    `source`), using the abbreviated names when `short_names` is true.
+    Returns the list of the field names.
+    """
+    # List fields in excel file and create corresponding fields in shapefile
+    print "\nMapping of fields contained in {0}:".format(source)
+    f_names = []
+    for a, b in xldata.dtypes.iteritems():
+        f_name = FIELD_NAME_MAPPING[a] if short_names else a
+        f_names.append(f_name)
+        f_type = FIELD_TYPE_MAPPING[str(b)]
+        print "{0:52} -> {1}".format(a, f_name)
+        field = ogr.FieldDefn(f_name, f_type)
+        if lyr.CreateField(field) != 0:
+            exit("\nERROR -> Error creating field '{0}' mapped from type '{1}'".format(f_name, b))
+    return f_names
+
+
+def write_features(lyr, lyr_name, xldata, f_names, wkb, batch, source):
+    """
+    Adds to `lyr` a feature for each row of `xldata` (read from `source`),
+    with the fields `f_names` and the geometry from the corresponding WKB
+    string of `wkb` (no geometry if `None`). The features are written in
+    transactions of `batch` features. Returns the number of features.
+    """
+    # Add the features to the layer in batches, each within a transaction
+    print "\nAdding features to '{0}' based on entries in {1}".format(lyr_name, source)
+    featDef = lyr.GetLayerDefn()  # Get feature definition from the layer
+
+    # Resolve the fields and prepare the typed values of each column once,
+    # avoiding any per-row indexing of the data frame
+    writers = field_writers(xldata, xldata.columns, featDef, f_names)
+    xl_len = len(xldata)
+    for start in xrange(0, xl_len, batch):
+        stop = min(start + batch, xl_len)
+        lyr.StartTransaction()
+        for row in xrange(start, stop):
+            # Prepare the feature
+            feat = ogr.Feature(featDef)  # Create a new feature
+            if wkb is not None:
+                # Create the requested feature geometry
+                geom = ogr.CreateGeometryFromWkb(wkb[row])
+                feat.SetGeometry(geom)  # Set the geometry of the feature
+                geom.Destroy()
+
+            # Fill the fields with the corresponding values
+            for idx, setter, vals in writers:
+                if vals[row] is not None:
+                    setter(feat, idx, vals[row])
+
+            # Create (add) the feature
+            if lyr.CreateFeature(feat) != 0:
+                lyr.RollbackTransaction()
+                exit("ERROR -> Failure creating feature '{0}' in layer '{1}'!".format(row, lyr_name))
+
+            # Clean up
+            feat.Destroy()
+        lyr.CommitTransaction()
+
+        # Update progress display
+        stdout.write("{0:3.2f}%\r".format(100.0 * stop / xl_len))
+        stdout.flush()
+
+    return xl_len
+
+
+def write_layer(shp, lyr_name, xldata, prj, dst_srs, args, source):
+    """
+    Creates the layer `lyr_name` in the output `shp` and adds a feature for
+    each row of `xldata` (read from `source`), using the geometries and the
+    options in `args`. With `args.dissolve`, the features are the routes
+    merged from the sections, also written to the table
+    '`lyr_name`_sections'. Returns the number of features.
+    """
+    DRIVER, LAYER_OPTIONS, SHORT_NAMES = OUTPUT_FORMATS[args.format]
+    print "\nCreating layer '{0}'".format(lyr_name)
+    if args.geom == "points":
+        lyr = shp.CreateLayer(lyr_name, srs=dst_srs, geom_type=ogr.wkbPoint, options=LAYER_OPTIONS)
+    elif args.geom == "lines" and args.dissolve:
+        lyr = shp.CreateLayer(lyr_name, srs=dst_srs, geom_type=ogr.wkbMultiLineStringM, options=LAYER_OPTIONS)
+    elif args.geom == "lines":
+        lyr = shp.CreateLayer(lyr_name, srs=dst_srs, geom_type=ogr.wkbLineString, options=LAYER_OPTIONS)
+    else:  # Buffered and squares are both polygons
+        lyr = shp.CreateLayer(lyr_name, srs=dst_srs, geom_type=ogr.wkbPolygon, options=LAYER_OPTIONS)
+
+    if lyr is None:
+        exit("\nERROR -> Error creating layer '{0}'!".format(lyr_name))
+
+    # Convert all the starting/ending GPS coordinates to the destination
+    # spatial reference at once and build the geometries from them
+    print "\nProjecting the GPS coordinates of {0}".format(source)
+    slat, slng, elat, elng = [xldata[c].values.astype(float) for c in (args.slat, args.slng, args.elat, args.elng)]
+    if args.geom == "points":
+        # Start/end coordinates shared by contiguous sections are written
+        # once, referencing all the sections they belong to
+        x, y = prj.prj_arr(np.concatenate([slng, elng]), np.concatenate([slat, elat]))
+        first, groups = shared_vertices(x, y, args.tol)
+        wkb = wkb_geometries("points", x[first, np.newaxis], y[first, np.newaxis])
+        if SECTION_KEY in xldata:
+            keys = xldata[SECTION_KEY].astype(str).values
+        else:
+            keys = np.arange(len(xldata)).astype(str)
+        sections = [np.unique(g % len(xldata)) for g in groups]
+        print "{0} unique vertices from {1} start/end coordinates".format(len(first), len(x))
+        xldata = DataFrame({"NSections": np.array([len(sec) for sec in sections], dtype=np.int64),
+                            "Sections": np.array([",".join(keys[sec]) for sec in sections], dtype=object)},
+                           columns=["NSections", "Sections"])
+    elif args.geom == "squares":
+        # Rectangle with the start/end coordinates at opposite corners
+        x, y = prj.prj_arr(np.concatenate([slng, elng, elng, slng]), np.concatenate([slat, slat, elat, elat]))
+        wkb = wkb_geometries("polygons", x.reshape(4, -1).T, y.reshape(4, -1).T)
+    elif args.geom == "buffered":
+        # Segments buffered all at once, with flat or round caps
+        x, y = prj.prj_arr(np.concatenate([slng, elng]), np.concatenate([slat, elat]))
+        segments = CAP_SEGMENTS if args.caps == "round" else 1
+        x, y = buffered_rings(x.reshape(2, -1).T, y.reshape(2, -1).T, args.buflen, segments)
+        wkb = wkb_geometries("polygons", x, y)
+    elif args.dissolve:
+        # Contiguous sections of each route merged into measured polylines
+        x, y = prj.prj_arr(np.concatenate([slng, elng]), np.concatenate([slat, elat]))
+        routes, wkb = dissolve_routes(xldata, x.reshape(2, -1).T, y.reshape(2, -1).T)
+        print "{0} routes dissolved from {1} sections".format(len(routes), len(xldata))
+    else:
+        x, y = prj.prj_arr(np.concatenate([slng, elng]), np.concatenate([slat, elat]))
+        wkb = wkb_geometries("lines", x.reshape(2, -1).T, y.reshape(2, -1).T)
+    if not args.dissolve:
+        wkb = [w.tostring() for w in wkb]
+
+    if args.dissolve:
+        # The sections are written (without geometry) to their own table,
+        # referenced by the routes through the milepoints
+        sec_name = "{0}_sections".format(lyr_name)
+        print "\nCreating table '{0}'".format(sec_name)
+        sec_lyr = shp.CreateLayer(sec_name, geom_type=ogr.wkbNone)
+        if sec_lyr is None:
+            exit("\nERROR -> Error creating table '{0}'!".format(sec_name))
+        f_names = create_fields(sec_lyr, xldata, SHORT_NAMES, source)
+        write_features(sec_lyr, sec_name, xldata, f_names, None, args.batch, source)
+        xldata = routes
+
+    f_names = create_fields(lyr, xldata, SHORT_NAMES, source)
+    return write_features(lyr, lyr_name, xldata, f_names, wkb, args.batch, source)
+
+def convert(job):
+    """
+    Converts the sheets `job['sheets']` of each excel file in `job['files']`
+    into the layers of the output file `job['output']` (a dictionary prepared
+    by `main` for each output file). Each workbook is parsed once.
+    The function can run in a worker process: it returns `None` on success
+    or the error message.
+    """
+    args = job['args']
+    try:
+        # Spatial references (exchanged as WKT with the worker processes)
+        src_srs = osr.SpatialReference()
+        src_srs.ImportFromWkt(job['src_wkt'])
+        dst_srs = osr.SpatialReference()
+        if job['dst_wkt']:
+            dst_srs.ImportFromWkt(job['dst_wkt'])
+
+        # Define coordinate transformation
+        prj = prjpnt(src_srs, dst_srs)
+
+        # Prepare the output file
+        DRIVER, LAYER_OPTIONS, SHORT_NAMES = OUTPUT_FORMATS[args.format]
+        print "\nCreating {0} file '{1}' using '{2}' features".format(DRIVER, job['output'], args.geom)
+        drv = ogr.GetDriverByName(DRIVER)
+        if drv is None:
+            exit("\nERROR -> Driver '{0}' not available!".format(DRIVER))
+        # Layers of the output: one for each sheet, plus the sections table
+        # when dissolving
+        n_layers = len(job['files']) * len(job['sheets']) * (2 if args.dissolve else 1)
+        ext = SINGLE_LAYER_EXT.get(args.format)
+        if ext and job['output'].lower().endswith(ext) and n_layers > 1:
+            exit("\nERROR -> {0} layers cannot be written to '{1}': use a directory as output".format(n_layers, job['output']))
+        if args.overwrite:
+            if exists(job['output']):
+                drv.DeleteDataSource(job['output'])
+        shp = drv.CreateDataSource(job['output'])
+        if shp is None:
+            exit("\nERROR -> Error creating {0} file '{1}'!".format(DRIVER, job['output']))
+
+        layers = []
+        for xls_file in job['files']:
+            # Open the excel file, parsing all the sheets at once
+            print "\nOpening sheets {0} from file '{1}'".format(", ".join("'{0}'".format(s) for s in job['sheets']), xls_file)
+            try:
+                sheets = read_excel(xls_file, sheetname=job['sheets'])
+            except IOError:
+                exit("\nERROR -> File '{0}' not found!".format(xls_file))
+            except Exception as e:
+                exit("\nERROR -> Error: '{0}'".format(e))
+
+            for sheet in job['sheets']:
+                xldata = sheets[sheet]
+                lyr_name = layer_name(args.layer, xls_file, sheet, xldata)
+                if lyr_name in layers:
+                    exit("\nERROR -> Layer '{0}' already written to '{1}': use a layer name template (see '--layer')".format(lyr_name, job['output']))
+                layers.append(lyr_name)
+                source = "'{0}'/'{1}'".format(xls_file, sheet)
+                xl_len = write_layer(shp, lyr_name, xldata, prj, dst_srs, args, source)
+                print "\nConversion of {0} features from {1} to '{2}'/'{3}' completed!".format(xl_len, source, job['output'], lyr_name)
+
+        # Close shapefile
+        shp.Destroy()
+    except SystemExit as e:
+        return e.code
 
-def main():
-    FIELD_NAME_MAPPING = {
-        "VDOT System ID":                                           "VDOTSysId",
-        "District":                                                 "District",
-        "County (Maint. Jurisd.)":                                  "CntyMntJr",
-        "LM's Invalid IRI":                                         "LMInvdIRI",
-        "Year":                                                     "Year",
-        "Link to External Information":                             "LnkExtInf",
-        "Pavement Type":                                            "PvmntType",
-        "Divided Flag":                                             "DivdFlag",
-        "Number of Travel Lanes":                                   "TrvlLnNmb",
-        "Lane Miles":                                               "LaneMiles",
-        "Pavement Type Code":                                       "PvmTypCod",
-        "Lane Width":                                               "LaneWidth",
-        "LDR":                                                      "LDR",
-        "NDR":                                                      "NDR",
-        "Deficient Lane Mileage":                                   "DefLanMil",
-        "LM's Valid IRI":                                           "LMValdIRI",
-        "S_Rut (in)":                                               "SRut_in",
-        "NIRI Average":                                             "NIRI_Avrg",
-        "IRI Left WP":                                              "IRILftWp",
-        "IRI Right WP":                                             "IRIRigWp",
-        "LM's Excellent IRI (0-59)":                                "LMExclIRI",
-        "LM's Good IRI (60-99)":                                    "LMGoodIRI",
-        "LM's Fair IRI (100-139)":                                  "LMFairIRI",
-        "LM's Poor IRI (140-199)":                                  "LMPoorIRI",
-        "LM's Very Poor IRI (200+)":                                "LMVrPrIRI",
-        "LM's Excellent CCI (90-100)":                              "LMExclCCI",
-        "LM's Good CCI (70-89)":                                    "LMGoodCCI",
-        "LM's Fair CCI (60-69)":                                    "LMFairCCI",
-        "LM's Poor CCI (50-59)":                                    "LMPoorCCI",
-        "LM's Very Poor CCI (0-49)":                                "LMVrPrCCI",
-        "Reflective Transverse Cracking Severity 2 (lin ft)":       "RTCS2_lft",
-        "Transverse Cracking Severity 1(lin ft)":                   "TCS1_lft",
-        "Transverse Cracking Severity 2 (lin ft)":                  "TCS2_lft",
-        "Longitudinal Cracking Severity 1 (lin ft)":                "LCS1_lft",
-        "Longitudinal Cracking Severity 2 (lin ft)":                "LCS2_lft",
-        "Longitudinal Joint Severity 1 (lin ft)":                   "LJS1_lft",
-        "Longitudinal Joint Severity 2 (lin ft)":                   "LJS2_lft",
-        "Reflective Transverse Cracking Severity 1 (lin ft)":       "RTCS1_lft",
-        "W_Rut (in)":                                               "W_Rut_in",
-        "Reflective Transverse Cracking Severity 3 (lin ft)":       "RTCS3_lft",
-        "Reflective Longitudinal Cracking Severity 1 (lin ft)":     "RLCS1_lft",
-        "Reflective Longitudinal Cracking Severity 2 (lin ft)":     "RLCS2_lft",
-        "Reflective Longitudinal Cracking Severity 3 (lin ft)":     "RLCS3_lft",
-        "Distress Length":                                          "Dstrs_len",
-        "Length":                                                   "Length",
-        "Alligator Sev 1 (sf)":                                     "AgtrS1_sf",
-        "Alligator Sev 2 (sf)":                                     "AgtrS2_sf",
-        "Patching Area - Wheel Path (sf)":                          "PcAWP_sf",
-        "Alligator Sev 3 (sf)":                                     "AgtrS3_sf",
-        "Delamination Area (sf)":                                   "DelmnA_sf",
-        "Patching Area - Non Wheel Path (sf)":                      "PcANWP_sf",
-        "Route Name":                                               "RouteName",
-        "County From":                                              "CntyFrom",
-        "Direction":                                                "Direction",
-        "Lane":                                                     "Lane",
-        "Offset":                                                   "Offset",
-        "County Beg. Milepoint":                                    "CntyBgMPt",
-        "County To":                                                "CntyTo",
-        "County End Milepoint":                                     "CntyEdMPt",
-        "CCI":                                                      "CCI",
-        "Potholes (count)":                                         "PothlsCnt",
-        "Bleeding Sev. 1 (sf)":                                     "BldgS1_sf",
-        "Bleeding Sev. 2 (sf)":                                     "BldgS2_sf",
-        "No Distress Rated":                                        "NDstrsRat",
-        "Start GPS Latitude":                                       "StrGPSLat",
-        "Start GPS Longitude":                                      "StrGPSLng",
-        "End GPS Latitude":                                         "EndGPSLat",
-        "End GPS Longitude":                                        "EndGPSLng",
-        "Bridge Flag":                                              "BrdgFlag",
-        "Construction Flag":                                        "CnstrFlag",
-        "Lane Deviation Flag":                                      "LnDevFlag",
-        "Attachment":                                               "Attachmnt",
-        "Comments":                                                 "Comments",
-        "SECTIONKEY":                                               "SectnKey",
-        "Field-Recorded Pavement Type":                             "FldRcPvTy",
-        "Surface Type":                                             "SurfType",
-        "Date Tested":                                              "DateTest",
-        "Speed (mph)":                                              "Speed_mph",
-        "Traffic Level (1,2,3)":                                    "TrfcLevel",
-        "Number of Trucks":                                         "TrucksNo",
-        "State Owner":                                              "StateOwnr",
-        "Strong ? (FWD)":                                           "StrongFWD",
-        "Begin Landmark":                                           "BgnLndMrk",
-        "End Landmark":                                             "EndLndMrk",
-        "Section Length":                                           "SectnLen",
-        "Notes":                                                    "Notes",
-        "Roadware Divided":                                         "RdwrDivd",
-        "Roadware Rated Lanes":                                     "RdwrRatLn",
-        "Roadware LRS Change":                                      "RdwrLRSCh",
-        "Roadware LRS Change Code":                                 "RdwrLRSCC",
-        "Roadware Pavement Type":                                   "RdwrPvTyp",
-        "Roadware Review Date":                                     "RdwrRevDt",
-        "Last Rehab Year":                                          "LastRhbYr",
-        "Date/Time Updated":                                        "DatTimUpd",
-        "User Update":                                              "UsrUpdate",
-        "LRM Currency Date":                                        "LRMCurDat",
-        "LRM Version Number":                                       "LRMVerNum",
-        "Network Date":                                             "NetwkDate",
-        "Previous Loc Ident":                                       "PrvLocID",
-        "Repeat ?":                                                 "Repeat",
-        "VDOT Maintained?":                                         "VDOTMntnd"}
-
-    FIELD_TYPE_MAPPING = {
-        "object":           ogr.OFTString,
-        "float64":          ogr.OFTReal,
-        "int64":            ogr.OFTInteger,
-        "datetime64[ns]":   ogr.OFTDateTime}
 
+def main():
     DESCRIPTION = "Convert VDOT 10th mile road condition XLS files into ESRI \
         shapefile where each feature can be either a point, a line, a buffered \
         line or polygon (rectangle) with extents identified by the GPS \
@@ -151,19 +604,27 @@ def main():
     parser = argparse.ArgumentParser(description=DESCRIPTION, version=VERSION)
 
     parser.add_argument("input_xls",
-                        help="Name of the excel file to use as input \
-                        (required).")
+                        help="Name (regular expressions are valid) of the \
+                        excel files to use as input (required).")
     parser.add_argument("output_shp",
-                        help="Name of the ESRI shapefile to use as output \
+                        help="Name of the ESRI shapefile (or of the file in \
+                        the format selected by '--format') to use as output. \
+                        '{name}' is replaced by the base name of each input \
+                        file, writing one output for each of them \
                         (required).")
 
     parser.add_argument("--sheet",
                         required=True,
-                        help="Name of the excel sheet to process (required).")
+                        nargs='+',
+                        help="Space separated names of the excel sheets to \
+                        process, each converted into its own layer \
+                        (required).")
     parser.add_argument("--layer",
                         required=True,
-                        help="Name of the shapefile layer containing the data \
-                        (required).")
+                        help="Name of the shapefile layer containing the data. \
+                        '{year}', '{sheet}' and '{name}' are replaced by the \
+                        year of the data, the sheet name and the base name \
+                        of the input file, e.g. '{sheet}_{year}' (required).")
 
     src_spref = parser.add_mutually_exclusive_group()
     src_spref.add_argument("--src_epsg",
@@ -189,6 +650,15 @@ def main():
                            help="URL of spatial reference to be used in the \
                            shapefile (see '--src_url).")
 
+    parser.add_argument("--format",
+                        default="shapefile",
+                        choices=sorted(OUTPUT_FORMATS),
+                        help="Format of the output file. GeoPackage and \
+                        FlatGeobuf files are written with a spatial index and \
+                        keep the full names of the excel columns, while the \
+                        shapefile fields are abbreviated to 10 characters \
+                        (default: '%(default)s').")
+
     parser.add_argument("--slat",
                         default="Start GPS Latitude",
                         help="Name of field containing starting GPS latitude \
@@ -218,6 +688,43 @@ def main():
                         option '--geom'. The radius is applied on both sides of \
                         each feature. The units are the same of the selected \
                         destination spatial reference (default: '%(default)3.2f').")
+    parser.add_argument("--caps",
+                        default="flat",
+                        choices=("flat", "round"),
+                        help="Caps of the 'buffered' features: 'flat' gives \
+                        oriented rectangles, 'round' half circles \
+                        approximated by {0} sides around the start/end \
+                        coordinates (default: '%(default)s').".format(CAP_SEGMENTS))
+    parser.add_argument("--tol",
+                        default=1e-6,
+                        type=float,
+                        help="Tolerance (size of the snapping grid) within \
+                        which start/end coordinates are merged into a \
+                        single vertex when 'points' is chosen for the option \
+                        '--geom'. The units are the same of the selected \
+                        destination spatial reference (default: '%(default)g').")
+
+    parser.add_argument("--dissolve",
+                        action="store_true",
+                        help="Merge the 'lines' of each route (county, route \
+                        name, direction and lane) into a single feature, \
+                        whose contiguous sections are the parts of a \
+                        polyline measured by the milepoints. The sections \
+                        are written without geometry to the table \
+                        '<layer>_sections' (default: 'False').")
+
+    parser.add_argument("--batch",
+                        default=10000,
+                        type=int,
+                        help="Number of features written within each layer \
+                        transaction (default: '%(default)s').")
+
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=1,
+                        help="Number of processes converting the input files \
+                        in parallel, when written to different outputs \
+                        (default: '%(default)s').")
 
     parser.add_argument("-o", "--overwrite",
                         action="store_true",
@@ -231,14 +738,18 @@ def main():
     print "- " + args.elat
     print "- " + args.elng
 
-    # Open the excel file
-    print "\nOpening sheet '{0}' from file '{1}'".format(args.sheet, args.input_xls)
-    try:
-        xldata = read_excel(args.input_xls, sheetname=args.sheet)
-    except IOError:
-        exit("\nERROR -> File '{0}' not found!".format(args.input_xls))
-    except Exception as e:
-        exit("\nERROR -> Error: '{0}'".format(e))
+    if args.geom == "buffered" and args.buflen <= 0:
+        exit("\nERROR -> Buffer radius must be positive for 'buffered' features (see '--buflen')")
+    if args.dissolve and args.geom != "lines":
+        exit("\nERROR -> Only 'lines' features can be dissolved (see '--geom')")
+    if args.geom == "points" and args.tol <= 0:
+        exit("\nERROR -> Tolerance must be positive for 'points' features (see '--tol')")
+
+    # Check if the input data exists
+    files = sorted(glob(args.input_xls))
+    if not files:
+        exit("\nERROR -> No file were selected using '{0}'".format(args.input_xls))
+    print "\n{0} files selected using '{1}'".format(len(files), args.input_xls)
 
     # Source data spatial reference
     SRC_DEF_EPSG_SRS = 4326
@@ -280,110 +791,37 @@ def main():
     else:
         print "\nWARNING -> No spatial reference will be defined for the shapefile!"
 
-    # Define coordinate transformation
-    transf = osr.CoordinateTransformation(src_srs, dst_srs)
-
-    # Prepare ESRI shapefile
-    DRIVER = "ESRI Shapefile"
-    print "\nCreating shapefile '{0}' using '{1}' features".format(args.output_shp, args.geom)
-    drv = ogr.GetDriverByName(DRIVER)
-    if drv is None:
-        exit("\nERROR -> Driver '{0}' not available!".format(DRIVER))
-    if args.overwrite:
-        if exists(args.output_shp):
-            drv.DeleteDataSource(args.output_shp)
-    shp = drv.CreateDataSource(args.output_shp)
-    if shp is None:
-        exit("\nERROR -> Error creating shapefile '{0}'!".format(args.output_shp))
-    print "\nCreating layer '{0}'".format(args.layer)
-    if args.geom == "points":
-        lyr = shp.CreateLayer(args.layer, srs=dst_srs, geom_type=ogr.wkbPoint)
-    elif args.geom == "lines":
-        lyr = shp.CreateLayer(args.layer, srs=dst_srs, geom_type=ogr.wkbLineString)
-    else:  # Buffered and squares are both polygons
-        lyr = shp.CreateLayer(args.layer, srs=dst_srs, geom_type=ogr.wkbPolygon)
-
-    if lyr is None:
-        exit("\nERROR -> Error creating layer '{0}'!".format(args.layer))
-
-    # List fields in excel file and create corresponding fields in shapefile
-    print "\nMapping of fields contained in '{0}'/'{1}':".format(args.input_xls, args.sheet)
-    for a, b in xldata.dtypes.iteritems():
-        f_name = FIELD_NAME_MAPPING[a]
-        f_type = FIELD_TYPE_MAPPING[str(b)]
-        print "{0:52} -> {1}".format(a, f_name)
-        field = ogr.FieldDefn(f_name, f_type)
-        if lyr.CreateField(field) != 0:
-            exit("\nERROR -> Error creating field '{0}' mapped from type '{1}'".format(f_name, b))
-
-    # Load the columns labels
-    labels = xldata.columns
-
-    # Iterate through rows of the excel file and add corresponding features to
-    # the shapefile
-    print "\nAdding features to '{0}' based on entries in '{1}'".format(args.output_shp, args.input_xls)
-    xl_len = len(xldata)
-    for row in range(xl_len):
-        # Get starting/ending GPS coordinates
-        slat, slng, elat, elng = xldata.ix[row][[args.slat, args.slng, args.elat, args.elng]]
-
-        # Create the requested feature geometry
-        if args.geom =="points":
-            # If points, only add the strat GPS coordinates.
-            # TODO: better implementation that includes all points without
-            # repetitions.
-            geom = ogr.Geometry(ogr.wkbPoint)
-            geom.AddPoint(slng, slat)
-            geom.Transform(transf)  # Convert to destination spatial reference
-        elif args.geom == "squares":
-            # Create a linear 2D ring (base for polygons)
-            ring = ogr.Geometry(ogr.wkbLinearRing)
-            ring.AddPoint(slng, slat)
-            ring.AddPoint(elng, slat)
-            ring.AddPoint(elng, elat)
-            ring.AddPoint(slng, elat)
-            ring.CloseRings()
-            ring.Transform(transf)  # Convret to destination spatial reference
-
-            # Create a polygon using the ring (rectangle)
-            geom = ogr.Geometry(ogr.wkbPolygon)
-            geom.AddGeometry(ring)
-        else:  # Both lines and buffered start with linear features:
-            # Create a linear feature
-            geom = ogr.Geometry(ogr.wkbLineString)
-            geom.AddPoint(slng, slat)
-            geom.AddPoint(elng, elat)
-            geom.Transform(transf)  # Convert to destination spatial reference
-            if args.geom == "buffered":
-                geom = geom.Buffer(args.buflen)
-
-        # Prepare the feature
-        featDef = lyr.GetLayerDefn()  # Get feature definition from the layer
-        feat = ogr.Feature(featDef)  # Create a new feature
-        feat.SetGeometry(geom)  # Set the geometry of the feature
-
-        # Fill the fields with the corresponding values
-        for l in labels:
-            feat.SetField(FIELD_NAME_MAPPING[l], str(xldata.ix[row][l]))
-
-        # Create (add) the feature
-        if lyr.CreateFeature(feat) != 0:
-            exit("ERROR -> Failure creating feature '{0}' in shapefile layer!".format(row))
-
-        # Clean up
-        feat.Destroy()
-        geom.Destroy()
-        if args.geom == "squares":
-            ring.Destroy()
-
-        # Update progress display
-        stdout.write("{0:3.2f}%\r".format(100.0 * (1 + row) / xl_len))
-        stdout.flush()
-
-    # Close shapefile
-    shp.Destroy()
+    # Group the input files by output file (named using their base name):
+    # each output is written by a single process
+    jobs = []
+    outputs = {}
+    for f in files:
+        output = args.output_shp.format(name=splitext(basename(f))[0])
+        if output not in outputs:
+            outputs[output] = {'output': output,
+                               'files': [],
+                               'sheets': args.sheet,
+                               'args': args,
+                               'src_wkt': src_srs.ExportToWkt(),
+                               'dst_wkt': dst_srs.ExportToWkt()}
+            jobs.append(outputs[output])
+        outputs[output]['files'].append(f)
+
+    # Convert the files, in parallel if requested
+    if args.workers > 1:
+        print "\nConverting {0} files into {1} outputs using {2} processes".format(len(files), len(jobs), args.workers)
+        pool = Pool(args.workers)
+        try:
+            errors = pool.map(convert, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = map(convert, jobs)
+    for e in errors:
+        if e:
+            exit(e)
 
-    print "\nConversion of {0} features from '{1}'/'{2}' to '{3}' completed!".format(xl_len, args.input_xls, args.sheet, args.output_shp)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()